@@ -0,0 +1,298 @@
+import os
+import re
+import time
+import zlib
+import base64
+import codecs
+import threading
+from typing import Dict, Iterator, List
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+# Limits keep one upload from spiking worker memory
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(2 * 1024 * 1024)))  # Decoded size per attachment
+MAX_ATTACHMENTS_PER_REQUEST = int(os.getenv("MAX_ATTACHMENTS_PER_REQUEST", "3"))
+MAX_PDF_INFLATED_BYTES = int(os.getenv("MAX_PDF_INFLATED_BYTES", str(4 * MAX_ATTACHMENT_BYTES)))  # Decompressed PDF streams
+MAX_SESSION_CHUNKS = int(os.getenv("MAX_SESSION_CHUNKS", "200"))
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "1800"))
+
+TEXT_MIME_TYPES = {"text/plain", "text/markdown", "text/csv", "text/html", "application/json"}
+PDF_MIME_TYPES = {"application/pdf"}
+
+_DATA_URL_PREFIX = re.compile(r"^data:[^,]*;base64,", re.IGNORECASE)
+
+
+def max_base64_chars(max_bytes: int) -> int:
+    """Longest contentString that can hold max_bytes: 4 characters per 3 bytes, MIME line breaks and a data URL prefix"""
+    encoded = 4 * -(-max_bytes // 3)
+    return encoded + 2 * -(-encoded // 76) + 256
+
+
+# Raw /ask body: every allowed attachment at its longest base64 form plus the rest of the JSON
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(
+    MAX_ATTACHMENTS_PER_REQUEST * max_base64_chars(MAX_ATTACHMENT_BYTES) + 64 * 1024)))
+
+
+class AttachmentError(ValueError):
+    """Attachment rejected (unsupported type or undecodable)"""
+
+
+class AttachmentTooLarge(AttachmentError):
+    """Attachment over the size limit"""
+
+
+def is_anonymous_session(session_id: str) -> bool:
+    """Anonymous requests all share the "guest" id, so they cannot own private attachments"""
+    return not session_id or session_id.strip().lower() == "guest"
+
+
+def iter_base64_decoded(content_string: str, chunk_chars: int = 64 * 1024) -> Iterator[bytes]:
+    """Decode a base64 payload piece by piece instead of materializing the whole blob"""
+    prefix = _DATA_URL_PREFIX.match(content_string)
+    start = prefix.end() if prefix else 0
+    chunk_chars -= chunk_chars % 4  # Decode on 4-character boundaries
+    pending = ""
+    for offset in range(start, len(content_string), chunk_chars):
+        piece = pending + "".join(content_string[offset:offset + chunk_chars].split())
+        usable = len(piece) - len(piece) % 4
+        pending = piece[usable:]
+        if usable:
+            try:
+                yield base64.b64decode(piece[:usable], validate=True)
+            except ValueError as e:
+                raise AttachmentError(f"Invalid base64 content: {e}")
+    if pending:
+        raise AttachmentError("Invalid base64 content: truncated padding")
+
+
+def inflate_stream(stream: bytes, max_length: int) -> bytes:
+    """Inflate one FlateDecode stream without producing more than max_length bytes"""
+    inflater = zlib.decompressobj()
+    # Ask for one byte past the budget so an over-budget stream is detectable
+    inflated = inflater.decompress(stream, max_length + 1)
+    if len(inflated) > max_length:
+        raise AttachmentTooLarge("PDF content inflates past the attachment size limit")
+    return inflated
+
+
+def extract_pdf_text(data: bytes, max_inflated_bytes: int = MAX_PDF_INFLATED_BYTES) -> str:
+    """Best-effort text extraction from a PDF using only the standard library.
+
+    Inflates FlateDecode content streams and collects the strings shown by the
+    Tj/TJ text operators - enough for typed notes and discharge summaries.
+    Compressed streams can expand a thousandfold, so the total inflated size is
+    capped and an over-budget PDF is rejected rather than decompressed.
+    """
+    texts = []
+    remaining = max_inflated_bytes
+    for match in re.finditer(rb"stream\r?\n(.*?)\r?\nendstream", data, re.DOTALL):
+        stream = match.group(1)
+        try:
+            stream = inflate_stream(stream, remaining)
+            remaining -= len(stream)
+        except zlib.error:
+            pass  # Uncompressed stream - already bounded by the attachment size
+        for block in re.finditer(rb"BT(.*?)ET", stream, re.DOTALL):
+            for string in re.finditer(rb"\(((?:\\.|[^\\)])*)\)", block.group(1)):
+                raw = re.sub(rb"\\([nrtbf()\\])", lambda m: {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"", b"f": b""}.get(m.group(1), m.group(1)), string.group(1))
+                texts.append(raw.decode("latin-1"))
+            texts.append("\n")
+    return re.sub(r"[ \t]+", " ", "".join(texts)).strip()
+
+
+class TextChunker:
+    """Splits streamed text into overlapping word windows"""
+
+    def __init__(self, chunk_words: int = 120, overlap_words: int = 20):
+        self.chunk_words = chunk_words
+        self.overlap_words = overlap_words
+        self.words = []
+        self.partial = ""
+        self.emitted = 0
+
+    def feed(self, text: str) -> List[str]:
+        """Add text and return any chunks that are now complete"""
+        if not text:
+            return []  # An incremental decode can yield nothing mid-character - keep the partial word pending
+        pieces = (self.partial + text).split()
+        # The last piece may be cut mid-word unless the text ended on whitespace
+        if pieces and not text[-1].isspace():
+            self.partial = pieces.pop()
+        else:
+            self.partial = ""
+        self.words.extend(pieces)
+
+        chunks = []
+        while len(self.words) >= self.chunk_words:
+            chunks.append(" ".join(self.words[:self.chunk_words]))
+            self.words = self.words[self.chunk_words - self.overlap_words:]
+        self.emitted += len(chunks)
+        return chunks
+
+    def flush(self) -> List[str]:
+        """Return the remaining words as a final chunk"""
+        if self.partial:
+            self.words.append(self.partial)
+            self.partial = ""
+        # After the first chunk the leading words are just overlap already indexed
+        has_new_words = len(self.words) > self.overlap_words or (self.words and not self.emitted)
+        chunks = [" ".join(self.words)] if has_new_words else []
+        self.words = []
+        return chunks
+
+
+class AttachmentReader:
+    """Incrementally reads one attachment's bytes into text chunks, enforcing the size limit"""
+
+    def __init__(self, name: str, mime: str, max_bytes: int = MAX_ATTACHMENT_BYTES):
+        self.name = name
+        self.mime = (mime or "").split(";")[0].strip().lower()
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.is_pdf = self.mime in PDF_MIME_TYPES or name.lower().endswith(".pdf")
+        if not self.is_pdf and self.mime not in TEXT_MIME_TYPES and not self.mime.startswith("text/"):
+            raise AttachmentError(f"Unsupported attachment type: {mime}")
+        self.pdf_buffer = bytearray()  # PDFs need the whole (bounded) file to parse
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.chunker = TextChunker()
+        self.chunks = []
+
+    def feed(self, data: bytes):
+        """Consume the next piece of the attachment"""
+        self.total_bytes += len(data)
+        if self.total_bytes > self.max_bytes:
+            raise AttachmentTooLarge(f"Attachment '{self.name}' exceeds {self.max_bytes} bytes")
+        if self.is_pdf:
+            self.pdf_buffer.extend(data)
+        else:
+            self.chunks.extend(self.chunker.feed(self.decoder.decode(data)))
+
+    def finish(self) -> List[str]:
+        """Flush buffered text and return all chunks"""
+        if self.is_pdf:
+            self.chunks.extend(self.chunker.feed(extract_pdf_text(bytes(self.pdf_buffer)) + " "))
+            self.pdf_buffer = bytearray()
+        else:
+            self.chunks.extend(self.chunker.feed(self.decoder.decode(b"", final=True) + " "))
+        self.chunks.extend(self.chunker.flush())
+        chunks = [chunk for chunk in self.chunks if chunk.strip()]
+        if not chunks:
+            # e.g. a scanned PDF (images only) - report it rather than "indexed, 0 chunks"
+            raise AttachmentError(f"No text could be extracted from '{self.name}'")
+        return chunks
+
+
+def read_base64_attachment(name: str, mime: str, content_string: str, max_bytes: int = MAX_ATTACHMENT_BYTES) -> List[str]:
+    """Decode and chunk a base64 attachment from a ChatRequest"""
+    # Cheap upfront check - the exact limit is enforced on the decoded bytes
+    if len(content_string) > max_base64_chars(max_bytes):
+        raise AttachmentTooLarge(f"Attachment '{name}' exceeds {max_bytes} bytes")
+    reader = AttachmentReader(name, mime, max_bytes)
+    for data in iter_base64_decoded(content_string):
+        reader.feed(data)
+    return reader.finish()
+
+
+class SessionAttachmentIndex:
+    """Small TF-IDF index over one session's attachment chunks"""
+
+    def __init__(self):
+        self.chunks = []  # (attachment name, chunk text)
+        self.vectorizer = None
+        self.vectors = None
+        self.last_access = time.monotonic()
+
+    def add(self, name: str, chunks: List[str], max_chunks: int = MAX_SESSION_CHUNKS):
+        """Add chunks (oldest dropped beyond max_chunks) and refit the index"""
+        self.chunks.extend((name, chunk) for chunk in chunks)
+        self.chunks = self.chunks[-max_chunks:]
+        self.vectorizer = TfidfVectorizer(stop_words='english', ngram_range=(1, 2), lowercase=True, sublinear_tf=True)
+        try:
+            self.vectors = self.vectorizer.fit_transform([chunk for _, chunk in self.chunks])
+        except ValueError:
+            # Only stop words in the chunks - nothing searchable
+            self.vectorizer = None
+            self.vectors = None
+
+    def search(self, query: str, top_k: int = 3) -> List[Dict]:
+        """Find the chunks most similar to the query"""
+        if self.vectorizer is None:
+            return []
+        similarities = cosine_similarity(self.vectorizer.transform([query]), self.vectors)[0]
+        results = []
+        for idx in similarities.argsort()[::-1][:top_k]:
+            name, chunk = self.chunks[idx]
+            results.append({
+                'question': f"attachment: {name}",
+                'answer': chunk,
+                'similarity': float(similarities[idx]),
+                'index': int(idx),
+                'aliases': [],
+                'source': 'attachment'
+            })
+        return results
+
+    def memory_bytes(self) -> int:
+        """Rough footprint of the chunk text and vectors"""
+        text_bytes = sum(len(chunk) for _, chunk in self.chunks)
+        vector_bytes = self.vectors.data.nbytes + self.vectors.indices.nbytes if self.vectors is not None else 0
+        return text_bytes + vector_bytes
+
+
+class SessionIndexStore:
+    """Per-session attachment indexes, evicted once a session is idle past its TTL"""
+
+    def __init__(self, ttl_seconds: int = SESSION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.indexes = {}
+        self.evicted_sessions = 0
+        self._lock = threading.Lock()
+
+    def evict_expired(self):
+        """Drop indexes of sessions idle longer than the TTL"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [sid for sid, index in self.indexes.items() if now - index.last_access > self.ttl_seconds]
+            for session_id in expired:
+                del self.indexes[session_id]
+            self.evicted_sessions += len(expired)
+        if expired:
+            print(f"Evicted attachment indexes for {len(expired)} expired session(s)")
+
+    def add(self, session_id: str, name: str, chunks: List[str]) -> int:
+        """Index an attachment's chunks for a session"""
+        if is_anonymous_session(session_id):
+            raise AttachmentError("Attachments need a unique sessionId")
+        self.evict_expired()
+        with self._lock:
+            index = self.indexes.setdefault(session_id, SessionAttachmentIndex())
+            index.add(name, chunks)
+            index.last_access = time.monotonic()
+            return len(index.chunks)
+
+    def search(self, session_id: str, query: str, top_k: int = 3) -> List[Dict]:
+        """Search a session's attachments (empty when it has none)"""
+        if is_anonymous_session(session_id):
+            return []
+        self.evict_expired()
+        with self._lock:
+            index = self.indexes.get(session_id)
+            if index is None:
+                return []
+            index.last_access = time.monotonic()
+            return index.search(query, top_k)
+
+    def drop(self, session_id: str):
+        """Forget a session's attachments"""
+        with self._lock:
+            self.indexes.pop(session_id, None)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                "sessions": len(self.indexes),
+                "chunks": sum(len(index.chunks) for index in self.indexes.values()),
+                "memory_bytes": sum(index.memory_bytes() for index in self.indexes.values()),
+                "evicted_sessions": self.evicted_sessions,
+                "ttl_seconds": self.ttl_seconds
+            }
@@ -0,0 +1,148 @@
+import os
+import json
+import mmap
+import struct
+import numpy as np
+from typing import Dict, List, Optional
+
+MAGIC = b"FAQSTOR1"
+ALIAS_SEPARATOR = "\n"
+_ALIGNMENT = 8
+
+
+class CorpusStore:
+    """Read-only columnar store of the Q&A corpus.
+
+    Each text column is one contiguous UTF-8 buffer plus an int64 offsets array,
+    so row i of a column is buffer[offsets[i]:offsets[i + 1]]. Saved stores are
+    memory-mapped: pages are shared between workers and only touched rows are resident.
+
+    File layout: MAGIC, u64 header length, JSON header, then 8-byte aligned
+    offsets arrays and UTF-8 buffers at the positions recorded in the header.
+    """
+
+    COLUMNS = ("question", "answer", "aliases")
+
+    def __init__(self, rows: int, offsets: Dict[str, np.ndarray], buffers: Dict[str, memoryview],
+                 metadata: Optional[Dict] = None, path: Optional[str] = None, mapped: Optional[mmap.mmap] = None):
+        self.rows = rows
+        self.offsets = offsets
+        self.buffers = buffers
+        self.metadata = metadata or {}
+        self.path = path
+        self._mmap = mapped
+
+    def __len__(self) -> int:
+        return self.rows
+
+    @classmethod
+    def from_columns(cls, questions: List[str], answers: List[str], aliases: List[List[str]], metadata: Optional[Dict] = None) -> "CorpusStore":
+        """Pack text columns into buffers (build time)"""
+        columns = {
+            "question": questions,
+            "answer": answers,
+            "aliases": [ALIAS_SEPARATOR.join(a) for a in aliases]
+        }
+        offsets = {}
+        buffers = {}
+        for name, values in columns.items():
+            encoded = [value.encode("utf-8") for value in values]
+            column_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(e) for e in encoded], out=column_offsets[1:])
+            offsets[name] = column_offsets
+            buffers[name] = memoryview(b"".join(encoded))
+        return cls(len(questions), offsets, buffers, metadata)
+
+    @classmethod
+    def from_dataframe(cls, df, metadata: Optional[Dict] = None) -> "CorpusStore":
+        """Pack a question/answer(/aliases) DataFrame into a store (build time)"""
+        aliases = df['aliases'].tolist() if 'aliases' in df.columns else [[] for _ in range(len(df))]
+        return cls.from_columns(df['question'].tolist(), df['answer'].tolist(), aliases, metadata)
+
+    def save(self, path: str):
+        """Write the store to disk (atomically, via a temp file)"""
+        layout = {}
+        position = 0
+        for name in self.COLUMNS:
+            offsets_at = position
+            position += self.offsets[name].nbytes
+            data_at = position
+            position += len(self.buffers[name])
+            position += -position % _ALIGNMENT
+            layout[name] = {"offsets_at": offsets_at, "data_at": data_at, "data_len": len(self.buffers[name])}
+
+        header = json.dumps({"rows": self.rows, "columns": layout, "metadata": self.metadata}).encode("utf-8")
+        header += b" " * (-(len(MAGIC) + 8 + len(header)) % _ALIGNMENT)
+        base = len(MAGIC) + 8 + len(header)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for name in self.COLUMNS:
+                assert f.tell() == base + layout[name]["offsets_at"]
+                f.write(self.offsets[name].astype("<i8").tobytes())
+                f.write(self.buffers[name])
+                f.write(b"\0" * (-f.tell() % _ALIGNMENT))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, use_mmap: bool = True) -> "CorpusStore":
+        """Open a saved store; with use_mmap the buffers are views straight into the mapped file"""
+        with open(path, "rb") as f:
+            if use_mmap:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        view = memoryview(data)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a corpus store")
+        (header_len,) = struct.unpack_from("<Q", view, len(MAGIC))
+        header_start = len(MAGIC) + 8
+        header = json.loads(bytes(view[header_start:header_start + header_len]).decode("utf-8"))
+        base = header_start + header_len
+
+        rows = header["rows"]
+        offsets = {}
+        buffers = {}
+        for name, layout in header["columns"].items():
+            offsets[name] = np.frombuffer(data, dtype="<i8", count=rows + 1, offset=base + layout["offsets_at"])
+            data_at = base + layout["data_at"]
+            buffers[name] = view[data_at:data_at + layout["data_len"]]
+        return cls(rows, offsets, buffers, header.get("metadata", {}), path, data if use_mmap else None)
+
+    def get_bytes(self, column: str, row: int) -> memoryview:
+        """Zero-copy slice of one cell"""
+        offsets = self.offsets[column]
+        return self.buffers[column][offsets[row]:offsets[row + 1]]
+
+    def get_text(self, column: str, row: int) -> str:
+        return str(self.get_bytes(column, row), "utf-8")
+
+    def question(self, row: int) -> str:
+        return self.get_text("question", row)
+
+    def answer(self, row: int) -> str:
+        return self.get_text("answer", row)
+
+    def aliases(self, row: int) -> List[str]:
+        joined = self.get_text("aliases", row)
+        return joined.split(ALIAS_SEPARATOR) if joined else []
+
+    def search_text(self, row: int) -> str:
+        """Canonical question plus its aliases - the text the vectors are built from"""
+        return " ".join([self.question(row)] + self.aliases(row))
+
+    def get_stats(self) -> Dict:
+        """Memory footprint of the store"""
+        buffer_bytes = sum(len(buffer) for buffer in self.buffers.values())
+        offsets_bytes = sum(offsets.nbytes for offsets in self.offsets.values())
+        return {
+            "rows": self.rows,
+            "buffer_bytes": buffer_bytes,
+            "offsets_bytes": offsets_bytes,
+            "total_bytes": buffer_bytes + offsets_bytes,
+            "memory_mapped": self._mmap is not None,
+            "path": self.path
+        }
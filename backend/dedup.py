@@ -0,0 +1,117 @@
+import re
+import zlib
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Set, Tuple
+
+# Universal hash family h(x) = (a * x + b) mod p over 32-bit shingle hashes. With a, b and x
+# below 2^32, a * x + b < 2^64, so the uint64 arithmetic is exact before the modulo
+_PRIME = 4294967311  # Smallest prime above 2^32
+_MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text: str, k: int = 5) -> Set[int]:
+    """Hash the word k-shingles of a text into 32-bit integers"""
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < k:
+        return {zlib.crc32(' '.join(words).encode('utf-8'))} if words else set()
+    return {zlib.crc32(' '.join(words[i:i + k]).encode('utf-8')) for i in range(len(words) - k + 1)}
+
+
+def jaccard(a: Set[int], b: Set[int]) -> float:
+    """Exact Jaccard similarity between two shingle sets"""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHashLSH:
+    """MinHash signatures bucketed with LSH banding to find candidate duplicate pairs"""
+
+    def __init__(self, num_perm: int = 128, bands: int = 32, seed: int = 42):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _MAX_HASH + 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, _MAX_HASH + 1, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingle_set: Set[int]) -> np.ndarray:
+        """Compute the MinHash signature of a shingle set"""
+        if not shingle_set:
+            return np.full(self.num_perm, _PRIME, dtype=np.uint64)  # Above every real hash value
+        values = np.fromiter(shingle_set, dtype=np.uint64)
+        hashes = (np.outer(values, self.a) + self.b) % _PRIME
+        return hashes.min(axis=0)
+
+    def candidate_pairs(self, signatures: List[np.ndarray]) -> Set[Tuple[int, int]]:
+        """Return index pairs that share at least one LSH band bucket"""
+        pairs = set()
+        for band in range(self.bands):
+            start = band * self.rows
+            buckets = {}
+            for idx, sig in enumerate(signatures):
+                buckets.setdefault(sig[start:start + self.rows].tobytes(), []).append(idx)
+            for members in buckets.values():
+                for i in range(len(members)):
+                    for j in range(i + 1, len(members)):
+                        pairs.add((members[i], members[j]))
+        return pairs
+
+
+def collapse_near_duplicates(df: pd.DataFrame, threshold: float = 0.8, shingle_size: int = 5) -> Tuple[pd.DataFrame, Dict]:
+    """Collapse Q&A pairs with near-identical answers into one canonical entry.
+
+    The first row of each group becomes the canonical entry; the other questions
+    are kept as aliases so every phrasing still contributes to retrieval.
+    """
+    answer_shingles = [shingles(answer, shingle_size) for answer in df['answer'].tolist()]
+    lsh = MinHashLSH()
+    signatures = [lsh.signature(s) for s in answer_shingles]
+
+    # Union-find over verified candidate pairs
+    parent = list(range(len(df)))
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j in lsh.candidate_pairs(signatures):
+        if jaccard(answer_shingles[i], answer_shingles[j]) >= threshold:
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = {}
+    for idx in range(len(df)):
+        groups.setdefault(find(idx), []).append(idx)
+
+    questions = df['question'].tolist()
+    answers = df['answer'].tolist()
+    rows = []
+    for root in sorted(groups):
+        members = groups[root]
+        aliases = []
+        for idx in members[1:]:
+            if questions[idx] != questions[root] and questions[idx] not in aliases:
+                aliases.append(questions[idx])
+        rows.append({
+            'question': questions[root],
+            'answer': answers[root],
+            'aliases': aliases
+        })
+
+    collapsed = pd.DataFrame(rows, columns=['question', 'answer', 'aliases'])
+    original_rows = len(df)
+    stats = {
+        "original_rows": original_rows,
+        "collapsed_rows": len(collapsed),
+        "groups_merged": sum(1 for members in groups.values() if len(members) > 1),
+        "reduction_pct": round(100.0 * (original_rows - len(collapsed)) / original_rows, 1) if original_rows else 0.0,
+        "threshold": threshold
+    }
+    return collapsed, stats
@@ -1,86 +1,114 @@
-import pandas as pd
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import pickle
-import os
 import re
 import requests
 import json
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from sklearn.preprocessing import normalize
 from typing import List, Dict
+from knowledge_base import GenerationManager, KnowledgeBase, preprocess_text
+from kb_registry import KnowledgeBaseRegistry
+from prompt_builder import PromptBuilder
+from generation_policy import GenerationPolicy, HtmlCompletionTracker
+from tracing import tracer
+from attachments import SessionIndexStore, is_anonymous_session
 
 class EnhancedFirstAidRAG:
-    def __init__(self, csv_path: str = "firstaidqa-00000-of-00001 (1).csv", ollama_host: str = "ollama:11434"):
+    def __init__(self, csv_path: str = "firstaidqa-00000-of-00001 (1).csv", ollama_host: str = "ollama:11434", dedup_threshold: float = 0.8,
+                 num_shards: int = 1):
         self.csv_path = csv_path
         self.ollama_host = ollama_host
-        self.vectorizer = TfidfVectorizer(
-            max_features=5000,
-            stop_words='english',
-            ngram_range=(1, 2),
-            lowercase=True
-        )
-        self.df = None
-        self.question_vectors = None
-        self.vectors_file = "question_vectors.pkl"
+        self.dedup_threshold = dedup_threshold  # Answer similarity for collapsing near-duplicates (None disables)
+        self.generations = GenerationManager(csv_path, dedup_threshold=dedup_threshold,
+                                             num_shards=num_shards)  # Blue/green knowledge base, optionally sharded
+        self.registry = KnowledgeBaseRegistry(self.generations, num_shards=num_shards)  # Named corpora, loaded on demand
         self.available_models = []
         self.preferred_models = ["qwen2:1.5b", "phi3:mini", "gemma:2b", "mistral:latest", "mistral", "llama2:7b", "llama2"]  # Order by speed and preference
         self.conversation_histories = {}  # Dictionary to store per-profile conversation histories
-        self.current_profile_id = "guest"  # Default profile ID
-        
+        self._request_state = threading.local()  # Requests run concurrently in a threadpool - profile and stats are per thread
+        self.prompt_builder = PromptBuilder()  # Token-budgeted prompts per model
+        self.generation_policy = GenerationPolicy()  # Adaptive num_predict per query class and model
+        self.session_indexes = SessionIndexStore()  # Per-session indexes of uploaded attachments
+        self.session_query_cache = OrderedDict()  # Per-profile query vector and results from the last turn (LRU)
+        self._session_cache_lock = threading.Lock()
+        self.max_cached_sessions = 1000
+        self.follow_up_decay = 0.5  # Weight of the previous turns' vector when blending in a follow-up
+        
+    @property
+    def current_profile_id(self) -> str:
+        """Profile of the request being handled on this thread"""
+        return getattr(self._request_state, "profile_id", "guest")
+
+    @current_profile_id.setter
+    def current_profile_id(self, profile_id: str):
+        self._request_state.profile_id = profile_id
+
+    @property
+    def last_ollama_stats(self) -> Dict:
+        """Token counts and timings from this thread's most recent Ollama call"""
+        return getattr(self._request_state, "ollama_stats", {})
+
+    @last_ollama_stats.setter
+    def last_ollama_stats(self, stats: Dict):
+        self._request_state.ollama_stats = stats
+
     def preprocess_text(self, text: str) -> str:
         """Simple text preprocessing"""
-        text = re.sub(r'\s+', ' ', text.strip())
-        text = text.replace('"', '').replace("'", "")
-        return text.lower()
-        
-    def load_data(self):
-        """Load the CSV data"""
-        print("Loading first aid dataset...")
-        self.df = pd.read_csv(self.csv_path)
-        
-        # Clean the data
-        self.df['question'] = self.df['question'].apply(self.preprocess_text)
-        self.df['answer'] = self.df['answer'].apply(self.preprocess_text)
-        
-        print(f"Loaded {len(self.df)} Q&A pairs")
-        
-    def generate_vectors(self, force_regenerate: bool = False):
-        """Generate TF-IDF vectors for all questions"""
-        if os.path.exists(self.vectors_file) and not force_regenerate:
-            print("Loading cached vectors...")
-            with open(self.vectors_file, 'rb') as f:
-                data = pickle.load(f)
-                self.question_vectors = data['vectors']
-                self.vectorizer = data['vectorizer']
-        else:
-            print("Generating TF-IDF vectors for questions...")
-            questions = self.df['question'].tolist()
-            self.question_vectors = self.vectorizer.fit_transform(questions)
-            
-            # Cache vectors for faster startup next time
-            with open(self.vectors_file, 'wb') as f:
-                pickle.dump({
-                    'vectors': self.question_vectors,
-                    'vectorizer': self.vectorizer
-                }, f)
-            print("Vectors cached for future use")
+        return preprocess_text(text)
+    
+    @property
+    def knowledge_base(self) -> KnowledgeBase:
+        """The knowledge base generation currently serving"""
+        return self.generations.current
     
-    def search_similar_questions(self, query: str, top_k: int = 3) -> List[Dict]:
+    def search_similar_questions(self, query: str, top_k: int = 3, knowledge_base: KnowledgeBase = None) -> List[Dict]:
         """Find the most similar questions to the user query"""
-        processed_query = self.preprocess_text(query)
-        query_vector = self.vectorizer.transform([processed_query])
-        
-        similarities = cosine_similarity(query_vector, self.question_vectors)[0]
-        top_indices = np.argsort(similarities)[::-1][:top_k]
-        
-        results = []
-        for idx in top_indices:
-            results.append({
-                'question': self.df.iloc[idx]['question'],
-                'answer': self.df.iloc[idx]['answer'],
-                'similarity': float(similarities[idx]),
-                'index': int(idx)
-            })
+        # Callers pin a generation for the whole request; otherwise use whichever is current
+        knowledge_base = knowledge_base or self.generations.current
+        return knowledge_base.search(query, top_k)
+    
+    def search_with_session_context(self, query: str, profile_id: str, is_follow_up: bool,
+                                    knowledge_base: KnowledgeBase = None, top_k: int = 3) -> List[Dict]:
+        """Retrieve for the current turn, blending a follow-up with the session's cached query vector.
+        
+        Only the new question is vectorized. For a follow-up it is added to the previous
+        turn's (already blended) vector scaled by follow_up_decay, so older turns fade
+        geometrically and retrieval stays on the current topic. Anonymous requests all
+        share the "guest" profile, so they are never blended or cached.
+        """
+        knowledge_base = knowledge_base or self.generations.current
+        query_vector = knowledge_base.vectorize(query)
+        if is_anonymous_session(profile_id):
+            return knowledge_base.search_vector(query_vector, top_k)
+        
+        with self._session_cache_lock:
+            cached = self.session_query_cache.get(profile_id)
+        # Vectors from another generation live in a different vocabulary
+        if cached and cached['generation_id'] != knowledge_base.generation_id:
+            cached = None
+        
+        if is_follow_up and cached:
+            if query_vector.nnz == 0:
+                # Nothing searchable in the follow-up itself - stay with the previous turn's matches
+                blended_vector = cached['vector']
+                results = cached['results'][:top_k]
+            else:
+                blended_vector = normalize(query_vector + self.follow_up_decay * cached['vector'])
+                results = knowledge_base.search_vector(blended_vector, top_k)
+        else:
+            blended_vector = query_vector
+            results = knowledge_base.search_vector(query_vector, top_k)
+        
+        with self._session_cache_lock:
+            self.session_query_cache[profile_id] = {
+                'vector': blended_vector,
+                'results': results,
+                'generation_id': knowledge_base.generation_id
+            }
+            self.session_query_cache.move_to_end(profile_id)
+            while len(self.session_query_cache) > self.max_cached_sessions:
+                self.session_query_cache.popitem(last=False)
         
         return results
     
@@ -97,48 +125,19 @@ class EnhancedFirstAidRAG:
         # Fallback to phi3:mini (shouldn't happen if we check properly)
         return "phi3:mini"
     
-    def query_ollama(self, prompt: str, model: str = None) -> str:
+    def query_ollama(self, prompt: str, model: str = None, query_class: str = "general") -> str:
         """Query Ollama LLM"""
         if model is None:
             model = self.get_best_model()
+        self.last_ollama_stats = {}
             
         try:
-            # Adjust parameters based on model type
-            options = {
-                "temperature": 0.7,
-                "top_p": 0.9
-            }
-            
-            # Model-specific optimizations for speed and quality
-            if "mistral" in model.lower():
-                options = {
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "top_k": 20,        # Reduce choices for faster decisions
-                    "num_predict": 800  # Increased for comprehensive first aid instructions
-                }
-            elif "qwen2" in model.lower():
-                options = {
-                    "temperature": 0.5,     # Lower for faster, very focused responses
-                    "top_p": 0.85,         # Slightly more focused
-                    "top_k": 10,           # Very fast token selection
-                    "num_predict": 600,    # Increased for detailed medical responses
-                    "repeat_penalty": 1.15  # Prevent repetition in small model
-                }
-                # Ultra-fast mode for qwen2
-            elif "phi3" in model.lower():
-                options = {
-                    "temperature": 0.6,     # Slightly lower for faster, more focused responses
-                    "top_p": 0.9,
-                    "top_k": 15,           # Faster token selection
-                    "num_predict": 700,    # Increased for complete first aid instructions
-                    "repeat_penalty": 1.1   # Prevent repetition loops
-                }
-                # Remove stop sequences for phi3 to prevent truncation
-            else:
-                options["stop"] = ["\n\n"]
+            # num_predict, early-stop thresholds and sampling picked per query class and model
+            plan = self.generation_policy.plan(model, query_class)
+            options = plan["options"]
             
             # Switch back to /api/generate with proper streaming handling
+            request_start = time.perf_counter()
             response = requests.post(
                 f"http://{self.ollama_host}/api/generate",
                 json={
@@ -151,9 +150,16 @@ class EnhancedFirstAidRAG:
                 stream=True  # Enable streaming in requests 
             )
             
+            headers_received = time.perf_counter()
+            tracer.record_span("ollama.connect", request_start, headers_received, model=model, status=response.status_code)
+            
             if response.status_code == 200:
                 full_response = ""
                 final_data = {}
+                first_token_at = None
+                streamed_chunks = 0
+                stopped_early = False
+                html_tracker = HtmlCompletionTracker()
                 
                 # Process streaming response line by line
                 for line in response.iter_lines():
@@ -163,16 +169,41 @@ class EnhancedFirstAidRAG:
                             
                             # Accumulate response text
                             if 'response' in chunk_data:
+                                if first_token_at is None:
+                                    first_token_at = time.perf_counter()
                                 full_response += chunk_data['response']
+                                html_tracker.feed(chunk_data['response'])
+                                streamed_chunks += 1
                             
                             # Store final metadata when done
                             if chunk_data.get('done', False):
                                 final_data = chunk_data
                                 break
+                            
+                            # Stop once the HTML answer has finished its closing section (or is running away)
+                            if html_tracker.should_stop(plan["stop_words"], plan["runaway_words"]):
+                                stopped_early = True
+                                break
                                 
                         except json.JSONDecodeError:
                             continue
                 
+                if stopped_early:
+                    response.close()  # Dropping the stream makes Ollama stop generating
+                stream_end = time.perf_counter()
+                
+                # Prefill is the wait for the first token, decode is the rest of the stream
+                first_token_at = first_token_at or stream_end
+                tracer.record_span("ollama.prefill", headers_received, first_token_at, model=model,
+                                   prompt_eval_count=final_data.get('prompt_eval_count'))
+                tracer.record_span("ollama.decode", first_token_at, stream_end, model=model,
+                                   eval_count=final_data.get('eval_count', streamed_chunks), stopped_early=stopped_early)
+                
+                # Each streamed chunk is one token, which stands in for eval_count when we cut the stream
+                eval_count = final_data.get('eval_count', streamed_chunks)
+                truncated = final_data.get('done_reason') == 'length'
+                self.generation_policy.record(model, query_class, eval_count, truncated=truncated, stopped_early=stopped_early)
+                
                 # Debug logging - show complete prompt being sent to Ollama
                 print(f"=== OLLAMA PROMPT DEBUG ===")
                 print(f"Model: {model}")
@@ -185,10 +216,24 @@ class EnhancedFirstAidRAG:
                 print(f"Response length: {len(full_response)} chars")
                 print(f"Done: {final_data.get('done', 'unknown')}")
                 print(f"Total duration: {final_data.get('total_duration', 'unknown')}")
+                print(f"Prompt eval count: {final_data.get('prompt_eval_count', 'unknown')}")
                 print(f"Eval count: {final_data.get('eval_count', 'unknown')}")
+                print(f"Query class: {query_class}, stopped early: {stopped_early}, truncated: {truncated}")
                 print(f"Full response: '{full_response}'")
                 print(f"=== END STREAMING DEBUG ===")
                 
+                self.last_ollama_stats = {
+                    key: final_data[key]
+                    for key in ("prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration", "total_duration")
+                    if key in final_data
+                }
+                self.last_ollama_stats.update({
+                    "eval_count": eval_count,
+                    "num_predict": options["num_predict"],
+                    "query_class": query_class,
+                    "stopped_early": stopped_early
+                })
+                
                 return full_response if full_response else None
             else:
                 print(f"Ollama generate error: {response.status_code} - {response.text}")
@@ -200,7 +245,8 @@ class EnhancedFirstAidRAG:
             print(f"Failed to connect to Ollama: {e}")
             return None
     
-    def get_answer(self, query: str, profile_info: Dict = None, profile_id: str = "guest", similarity_threshold: float = 0.1) -> Dict:
+    def get_answer(self, query: str, profile_info: Dict = None, profile_id: str = "guest", similarity_threshold: float = 0.1,
+                   knowledge_base: KnowledgeBase = None) -> Dict:
         """Get enhanced answer using RAG + Ollama with smart conversation context"""
         # Set the current profile for this request
         self.set_current_profile(profile_id)
@@ -209,18 +255,38 @@ class EnhancedFirstAidRAG:
         original_query = query
         
         # Check if this is just a greeting first
-        if self.is_greeting(query):
+        with tracer.span("is_greeting"):
+            greeting = self.is_greeting(query)
+        if greeting:
             greeting_response = self.get_greeting_response(query)
             # Don't store greetings in conversation history
             return greeting_response
         
         # Add conversation context if this seems like a follow-up question
-        contextual_query = self.add_conversation_context(query)
-        
-        similar_questions = self.search_similar_questions(contextual_query, top_k=3)
+        with tracer.span("add_conversation_context"):
+            contextual_query = self.add_conversation_context(query)
+        
+        # Pin the serving generation (callers resolve named corpora up front) so a hot swap
+        # or eviction mid-request doesn't mix corpora
+        knowledge_base = knowledge_base or self.generations.current
+        # Retrieval uses the question alone (blended with the session's cached vector for follow-ups);
+        # the conversation context only goes into the prompt
+        is_follow_up = contextual_query != query
+        with tracer.span("search_similar_questions", top_k=3, generation=knowledge_base.generation_id, follow_up=is_follow_up):
+            similar_questions = self.search_with_session_context(query, profile_id, is_follow_up, knowledge_base, top_k=3)
+        
+        # Relevant chunks of the session's own attachments only go into the prompt - their similarity
+        # comes from a tiny per-session index, so they are never ranked against the corpus or shown as sources
+        with tracer.span("search_session_attachments"):
+            attachment_matches = [match for match in self.session_indexes.search(profile_id, query, top_k=2)
+                                  if match['similarity'] >= 0.1]
+        
+        # Classify on the user's own words - the follow-up context would skew it
+        query_class = self.generation_policy.classify(original_query, is_follow_up=is_follow_up)
         
         # Try Ollama-enhanced response first (with profile context)
-        ollama_response = self.get_ollama_enhanced_answer(contextual_query, similar_questions, profile_info)
+        ollama_response = self.get_ollama_enhanced_answer(contextual_query, similar_questions, profile_info, query_class,
+                                                          attachment_matches)
         if ollama_response:
             # Update conversation history with the original query and response
             self.update_conversation_history(original_query, ollama_response['answer'])
@@ -249,8 +315,12 @@ class EnhancedFirstAidRAG:
         self.update_conversation_history(original_query, result['answer'])
         return result
     
-    def get_ollama_enhanced_answer(self, query: str, similar_questions: List[Dict], profile_info: Dict = None) -> Dict:
+    def get_ollama_enhanced_answer(self, query: str, similar_questions: List[Dict], profile_info: Dict = None, query_class: str = None,
+                                   attachment_matches: List[Dict] = None) -> Dict:
         """Get answer using Ollama with RAG context and profile information"""
+        if query_class is None:
+            query_class = self.generation_policy.classify(query)
+
         # Debug: Show what profile info we received
         print(f"=== PROFILE INFO DEBUG ===")
         print(f"Profile info received: {profile_info}")
@@ -273,74 +343,59 @@ Please consider these details when providing your response.
             print(profile_context)
             print(f"⚠️  NOTE: Profile information will be used for context but filtered from response")
         
+        model = self.get_best_model()
+        
         if not similar_questions or similar_questions[0]['similarity'] < 0.05:
             # No good matches, use Ollama alone
-            prompt = f"""You are a helpful first aid assistant. Please provide a clear, practical response to this first aid question (keep answers to 150-200 words):
-
-{profile_context}{query}
-
-IMPORTANT: Do NOT mention or repeat any patient information (age, gender, blood group, conditions) in your response. Use this information only as context to tailor your advice appropriately.
-
-Format your response using valid HTML with:
-- Use <h3> for section headings
-- Use <ol> or <ul> for step-by-step instructions
-- Use <strong> for important warnings or key points
-- Use <p> for paragraphs
-- Use <em> for emphasis when needed
-
-Provide specific steps and safety information. If this is a serious emergency, advise seeking immediate medical help."""
-            
-            ollama_response = self.query_ollama(prompt)
+            with tracer.span("prompt_build", model=model, grounded=False):
+                built = self.prompt_builder.build(query, [], model, profile_context, attachment_matches)
+            ollama_response = self.query_ollama(built["prompt"], model, query_class)
             if ollama_response:
-                sanitized_response = self.sanitize_response(ollama_response.strip(), profile_info)
+                with tracer.span("sanitize_response"):
+                    sanitized_response = self.sanitize_response(ollama_response.strip(), profile_info)
                 return {
                     "answer": sanitized_response,
                     "confidence": 0.5,
                     "source": "AI reasoning (no specific match found)",
                     "similar_questions": [],
-                    "method": "ollama_only"
+                    "method": "ollama_only",
+                    "prompt_tokens": self.get_prompt_token_report(built)
                 }
         else:
-            # Use RAG context with Ollama
-            context = similar_questions[0]['answer']  # Just use the best match
+            # Use RAG context with Ollama - extractive selection from the top matches under the model's budget
+            with tracer.span("prompt_build", model=model, grounded=True):
+                built = self.prompt_builder.build(query, similar_questions, model, profile_context, attachment_matches)
             
-            prompt = f"""You are a first aid assistant. Based on this relevant information from our knowledge base:
-
-{context}
-
-{profile_context}Now answer this question with clear, practical steps:
-
-{query}
-
-IMPORTANT: Do NOT mention or repeat any patient information (age, gender, blood group, conditions) in your response. Use this information only as context to tailor your advice appropriately.
-
-Format your response using valid HTML with:
-- Use <h3> for section headings
-- Use <ol> or <ul> for step-by-step instructions  
-- Use <strong> for important warnings or key points
-- Use <p> for paragraphs
-- Use <em> for emphasis when needed
-
-Use the knowledge base information and expand on it with helpful details."""
-            
-            ollama_response = self.query_ollama(prompt)
+            ollama_response = self.query_ollama(built["prompt"], model, query_class)
             if ollama_response:
-                sanitized_response = self.sanitize_response(ollama_response.strip(), profile_info)
+                with tracer.span("sanitize_response"):
+                    sanitized_response = self.sanitize_response(ollama_response.strip(), profile_info)
                 return {
                     "answer": sanitized_response,
                     "confidence": min(0.9, similar_questions[0]['similarity'] + 0.3),
                     "source": f"AI enhanced with knowledge from similar case",
                     "similar_questions": [q['question'][:80] + "..." if len(q['question']) > 80 else q['question'] for q in similar_questions[:3]],
-                    "method": "rag_plus_ollama"
+                    "method": "rag_plus_ollama",
+                    "prompt_tokens": self.get_prompt_token_report(built)
                 }
         
         return None  # Ollama failed, will fallback to pure RAG
     
+    def get_prompt_token_report(self, built: Dict) -> Dict:
+        """Prompt token counts for a request - our estimate, the budget, and what Ollama actually evaluated"""
+        report = {
+            "estimated": built["prompt_tokens"],
+            "context": built["context_tokens"],
+            "budget": built["budget"],
+            "evaluated": self.last_ollama_stats.get("prompt_eval_count")
+        }
+        print(f"=== PROMPT TOKENS === {report}")
+        return report
+
     def initialize(self):
         """Initialize the enhanced RAG system"""
         try:
-            self.load_data()
-            self.generate_vectors()
+            self.generations.load_initial()
             
             # Test Ollama connection and model availability
             print("Testing Ollama connection...")
@@ -378,7 +433,7 @@ Use the knowledge base information and expand on it with helpful details."""
             print(f"Selected model: {best_model}")
             
             # Test a simple query with the best model
-            test_result = self.query_ollama("Hello", best_model)
+            test_result = self.query_ollama("Hello", best_model, query_class="probe")
             if test_result is not None:
                 print(f"✅ Model {best_model} is working")
                 return True
@@ -526,7 +581,7 @@ Current question: {query}"""
         profile_history.append({
             'question': question,
             'answer': answer,
-            'timestamp': pd.Timestamp.now()
+            'timestamp': datetime.now()
         })
         
         # Keep only the most recent entries (limit to 5)
@@ -573,7 +628,10 @@ Current question: {query}"""
         print(f"Conversation history cleared for profile: {self.current_profile_id}")
     
     def clear_profile_history(self, profile_id: str):
-        """Clear conversation history for a specific profile"""
+        """Clear conversation history (and uploaded attachments) for a specific profile"""
+        self.session_indexes.drop(profile_id)
+        with self._session_cache_lock:
+            self.session_query_cache.pop(profile_id, None)
         if profile_id in self.conversation_histories:
             self.conversation_histories[profile_id] = []
             print(f"Cleared conversation history for profile: {profile_id}")
@@ -0,0 +1,196 @@
+import re
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+# Sampling options per model family (speed/quality tuned for CPU-only Ollama)
+MODEL_SAMPLING = {
+    "mistral": {"temperature": 0.7, "top_p": 0.9, "top_k": 20},
+    "qwen2": {"temperature": 0.5, "top_p": 0.85, "top_k": 10, "repeat_penalty": 1.15},  # Prevent repetition in small model
+    "phi3": {"temperature": 0.6, "top_p": 0.9, "top_k": 15, "repeat_penalty": 1.1},  # Prevent repetition loops
+}
+DEFAULT_SAMPLING = {"temperature": 0.7, "top_p": 0.9}
+
+# The prompt asks for 150-200 words
+ANSWER_MIN_WORDS = 150
+ANSWER_MAX_WORDS = 200
+
+# Per query class: starting num_predict, bounds, a temperature cap, and the early stops:
+# past stop_words a complete answer ends once its closing section (e.g. "When to seek help")
+# is written; past runaway_words any structurally complete answer is cut off
+QUERY_CLASSES = {
+    "emergency_steps": {"num_predict": 450, "min_predict": 300, "max_predict": 700, "stop_words": ANSWER_MIN_WORDS, "runaway_words": ANSWER_MAX_WORDS + 60, "max_temperature": 0.5},
+    "definition": {"num_predict": 300, "min_predict": 180, "max_predict": 500, "stop_words": ANSWER_MIN_WORDS, "runaway_words": ANSWER_MAX_WORDS + 60, "max_temperature": 0.6},
+    "follow_up": {"num_predict": 350, "min_predict": 200, "max_predict": 600, "stop_words": ANSWER_MIN_WORDS, "runaway_words": ANSWER_MAX_WORDS + 60, "max_temperature": 0.6},
+    "general": {"num_predict": 400, "min_predict": 250, "max_predict": 700, "stop_words": ANSWER_MIN_WORDS, "runaway_words": ANSWER_MAX_WORDS + 60, "max_temperature": 0.7},
+    "probe": {"num_predict": 8, "min_predict": 8, "max_predict": 8, "stop_words": 0, "runaway_words": 0, "max_temperature": 0.7},
+}
+
+# Headings that close a first aid answer - nothing after them is worth waiting for
+CLOSING_SECTION_PATTERN = re.compile(
+    r"when to|seek|get help|call (for|an ambulance|emergency|911|999|112)|medical (help|attention|care)|"
+    r"warning|caution|important|prevent|avoid|do not|don't|what not to|aftercare|follow[- ]up|summary",
+    re.IGNORECASE)
+
+EMERGENCY_TERMS = [
+    "bleeding", "bleed", "choking", "choke", "cpr", "unconscious", "not breathing", "heart attack",
+    "stroke", "seizure", "burn", "poison", "overdose", "fracture", "broken", "allergic", "anaphylaxis",
+    "drowning", "electric shock", "heatstroke", "hypothermia", "bite", "sting", "wound", "cut"
+]
+STEP_PATTERNS = [r"\bhow (do|should|can|to)\b", r"\bwhat (do|should) i do\b", r"\bwhat to do\b", r"\bsteps?\b", r"\btreat"]
+DEFINITION_PATTERNS = [r"^\s*what (is|are)\b", r"^\s*define\b", r"\bmeaning of\b", r"^\s*why\b", r"\bsymptoms? of\b"]
+
+
+class HtmlCompletionTracker:
+    """Tracks open HTML block tags in a streamed answer to tell when it is structurally complete"""
+
+    TAG_PATTERN = re.compile(r"<(/?)(h[1-6]|p|ol|ul|li|strong|em|b|i)\b[^>]*>", re.IGNORECASE)
+    BLOCK_END_PATTERN = re.compile(r"</(p|ol|ul)>\s*$", re.IGNORECASE)
+    HEADING_PATTERN = re.compile(r"<h[1-6]\b[^>]*>(.*?)</h[1-6]>", re.IGNORECASE | re.DOTALL)
+
+    def __init__(self):
+        self.text = ""
+        self.open_tags = []
+        self.scanned_upto = 0
+        self.seen_tags = False
+
+    def feed(self, chunk: str):
+        """Add streamed text and update the open tag stack"""
+        self.text += chunk
+        last_end = None
+        for match in self.TAG_PATTERN.finditer(self.text, self.scanned_upto):
+            closing, tag = match.group(1), match.group(2).lower()
+            self.seen_tags = True
+            if not closing:
+                self.open_tags.append(tag)
+            elif tag in self.open_tags:
+                # Pop back to the matching tag, tolerating unclosed inline tags
+                while self.open_tags and self.open_tags.pop() != tag:
+                    pass
+            last_end = match.end()
+        if last_end is not None:
+            self.scanned_upto = last_end
+
+    def word_count(self) -> int:
+        """Words of visible text so far"""
+        return len(re.sub(r"<[^>]*>", " ", self.text).split())
+
+    def is_complete(self) -> bool:
+        """True when every tag is closed and the text ends on a closed paragraph or list"""
+        return self.seen_tags and not self.open_tags and bool(self.BLOCK_END_PATTERN.search(self.text))
+
+    def ends_with_closing_section(self) -> bool:
+        """True when the last of several headings is a closing section and its content is complete"""
+        headings = self.HEADING_PATTERN.findall(self.text)
+        if len(headings) < 2 or not self.is_complete():
+            return False
+        return bool(CLOSING_SECTION_PATTERN.search(re.sub(r"<[^>]*>", "", headings[-1])))
+
+    def should_stop(self, stop_words: int, runaway_words: int) -> bool:
+        """Stop once a long enough answer has finished its closing section, or a runaway one is complete"""
+        if not stop_words or not self.is_complete():
+            return False
+        words = self.word_count()
+        return (words >= stop_words and self.ends_with_closing_section()) or words >= runaway_words
+
+
+class GenerationPolicy:
+    """Picks num_predict, early-stop thresholds and sampling options per query class and model.
+
+    num_predict adapts to a rolling history of the eval_count Ollama actually used
+    for each (model family, query class), with headroom so answers are not truncated.
+    Requests record and plan from threadpool workers concurrently, so the history is
+    only touched under a lock and read from copies.
+    """
+
+    def __init__(self, history_size: int = 50, headroom: float = 1.3):
+        self.history_size = history_size
+        self.headroom = headroom
+        self.history = {}  # (model family, query class) -> deque of (eval count, truncated)
+        self.early_stops = {}  # (model family, query class) -> number of answers cut at a complete HTML boundary
+        self._lock = threading.Lock()
+
+    def model_family(self, model: str) -> str:
+        """Map a model name to its family key"""
+        model_lower = (model or "").lower()
+        for family in MODEL_SAMPLING:
+            if family in model_lower:
+                return family
+        return model_lower.split(":")[0] or "default"
+
+    def classify(self, query: str, is_follow_up: bool = False) -> str:
+        """Classify the query intent"""
+        if is_follow_up:
+            return "follow_up"
+        query_lower = query.lower()
+        if any(re.search(pattern, query_lower) for pattern in DEFINITION_PATTERNS):
+            return "definition"
+        if any(term in query_lower for term in EMERGENCY_TERMS) or any(re.search(pattern, query_lower) for pattern in STEP_PATTERNS):
+            return "emergency_steps"
+        return "general"
+
+    def plan(self, model: str, query_class: str = "general") -> Dict:
+        """Build the Ollama options and early-stop threshold for a request"""
+        config = QUERY_CLASSES.get(query_class, QUERY_CLASSES["general"])
+        family = self.model_family(model)
+
+        options = dict(MODEL_SAMPLING.get(family, DEFAULT_SAMPLING))
+        options["temperature"] = min(options["temperature"], config["max_temperature"])
+        options["num_predict"] = self.get_num_predict(family, query_class)
+
+        return {
+            "options": options,
+            "query_class": query_class,
+            "model_family": family,
+            "stop_words": config["stop_words"],
+            "runaway_words": config["runaway_words"]
+        }
+
+    def get_num_predict(self, family: str, query_class: str) -> int:
+        """num_predict from the rolling history - high percentile plus headroom, within class bounds"""
+        config = QUERY_CLASSES.get(query_class, QUERY_CLASSES["general"])
+        with self._lock:
+            samples = list(self.history.get((family, query_class), ()))
+        if len(samples) < 5:
+            return config["num_predict"]
+
+        ordered = sorted(count for count, _ in samples)
+        p90 = ordered[min(len(ordered) - 1, int(0.9 * len(ordered)))]
+        num_predict = int(p90 * self.headroom)
+
+        # Recent truncations mean the budget is too tight - give it room again
+        if sum(1 for _, truncated in samples if truncated) > len(samples) * 0.1:
+            num_predict = max(num_predict, config["num_predict"])
+
+        return max(config["min_predict"], min(config["max_predict"], num_predict))
+
+    def record(self, model: str, query_class: str, eval_count: Optional[int], truncated: bool = False, stopped_early: bool = False):
+        """Record how many tokens a generation actually used"""
+        if not eval_count or query_class == "probe":
+            return
+        key = (self.model_family(model), query_class)
+        with self._lock:
+            if stopped_early:
+                # A cut-off answer says nothing about how long it would have run - keep it out of the p90
+                self.early_stops[key] = self.early_stops.get(key, 0) + 1
+                return
+            self.history.setdefault(key, deque(maxlen=self.history_size)).append((int(eval_count), truncated))
+
+    def get_stats(self) -> List[Dict]:
+        """Summary of the rolling history per model family and query class"""
+        with self._lock:
+            history = {key: list(samples) for key, samples in self.history.items()}
+            early_stops = dict(self.early_stops)
+        stats = []
+        for family, query_class in sorted(set(history) | set(early_stops)):
+            samples = history.get((family, query_class), [])
+            stats.append({
+                "model_family": family,
+                "query_class": query_class,
+                "samples": len(samples),
+                "avg_eval_count": round(sum(count for count, _ in samples) / len(samples), 1) if samples else None,
+                "num_predict": self.get_num_predict(family, query_class),
+                "recent_truncations": sum(1 for _, truncated in samples if truncated),
+                "early_stops": early_stops.get((family, query_class), 0)
+            })
+        return stats
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from knowledge_base import GenerationManager, KnowledgeBase
+
+DEFAULT_KNOWLEDGE_BASE = "default"
+KB_REGISTRY_FILE = os.getenv("KB_REGISTRY_FILE", "knowledge_bases.json")
+KB_MEMORY_BUDGET_MB = int(os.getenv("KB_MEMORY_BUDGET_MB", "512"))
+
+
+def load_registry_file(path: str) -> Dict[str, Dict]:
+    """Read the named corpora from a JSON file: {"name": {"csv_path": ..., "description": ...}}"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        entries = json.load(f)
+    registry = {}
+    for name, spec in entries.items():
+        if not isinstance(spec, dict) or not spec.get("csv_path"):
+            print(f"Skipping knowledge base '{name}': csv_path is required")
+            continue
+        registry[name] = spec
+    return registry
+
+
+class KnowledgeBaseRegistry:
+    """Named knowledge bases, loaded lazily on first use and evicted LRU under a memory budget.
+
+    The default knowledge base is the service's own blue/green generations and is
+    always resident. Every other corpus gets its own GenerationManager, so it loads
+    from its built artifacts (building them the first time) and can be rebuilt the
+    same way. Requests pin the KnowledgeBase they are handed (acquire/release), so
+    evicting a corpus only retires it: its shard workers stop once the last
+    request using it has finished.
+    """
+
+    def __init__(self, default: GenerationManager, entries: Optional[Dict[str, Dict]] = None,
+                 root_dir: str = "kb_collections", memory_budget_bytes: int = KB_MEMORY_BUDGET_MB * 1024 * 1024,
+                 num_shards: int = 1):
+        self.default = default
+        self.entries = entries if entries is not None else load_registry_file(KB_REGISTRY_FILE)
+        self.entries.pop(DEFAULT_KNOWLEDGE_BASE, None)
+        self.root_dir = root_dir
+        self.memory_budget_bytes = memory_budget_bytes
+        self.num_shards = num_shards
+        self.resident = OrderedDict()  # name -> {"manager", "bytes", "loaded_at", "load_seconds", "hits"}, LRU order
+        self.stats = {"hits": 0, "misses": 0, "loads": 0, "evictions": 0, "load_failures": 0, "evicted_bytes": 0}
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.entries}
+
+    def names(self) -> List[str]:
+        return [DEFAULT_KNOWLEDGE_BASE] + sorted(self.entries)
+
+    def has(self, name: Optional[str]) -> bool:
+        return not name or name == DEFAULT_KNOWLEDGE_BASE or name in self.entries
+
+    def acquire(self, name: Optional[str] = None) -> KnowledgeBase:
+        """Pin the serving generation of a named knowledge base, loading it on first use.
+
+        The caller must release() it when the request is done.
+        """
+        if not name or name == DEFAULT_KNOWLEDGE_BASE:
+            return self.default.acquire()
+        if name not in self.entries:
+            raise KeyError(f"Unknown knowledge base: {name}")
+
+        knowledge_base = self._touch(name)
+        if knowledge_base is not None:
+            return knowledge_base
+
+        # One load per corpus at a time; other corpora keep serving meanwhile
+        with self._load_locks[name]:
+            knowledge_base = self._touch(name)
+            if knowledge_base is not None:
+                return knowledge_base
+            return self._load(name)
+
+    def _touch(self, name: str) -> Optional[KnowledgeBase]:
+        with self._lock:
+            entry = self.resident.get(name)
+            if entry is None:
+                return None
+            self.resident.move_to_end(name)
+            entry["hits"] += 1
+            self.stats["hits"] += 1
+            # Pinned under the registry lock, so an eviction cannot slip in between
+            return entry["manager"].acquire()
+
+    def _load(self, name: str) -> KnowledgeBase:
+        spec = self.entries[name]
+        with self._lock:
+            self.stats["misses"] += 1
+        print(f"Loading knowledge base '{name}' from {spec['csv_path']}...")
+        start = time.time()
+        manager = GenerationManager(spec["csv_path"], root_dir=os.path.join(self.root_dir, name),
+                                    dedup_threshold=spec.get("dedup_threshold", self.default.dedup_threshold),
+                                    num_shards=self.num_shards)
+        try:
+            knowledge_base = manager.load_initial()
+        except Exception:
+            with self._lock:
+                self.stats["load_failures"] += 1
+            raise
+
+        with self._lock:
+            self.resident[name] = {
+                "manager": manager,
+                "bytes": knowledge_base.memory_bytes(),
+                "loaded_at": time.time(),
+                "load_seconds": round(time.time() - start, 3),
+                "hits": 0
+            }
+            self.stats["loads"] += 1
+            knowledge_base = manager.acquire()
+            evicted = self._evict_over_budget(keep=name)
+        for evicted_name, evicted_manager in evicted:
+            print(f"Evicted knowledge base '{evicted_name}' to stay within the memory budget")
+            evicted_manager.retire()
+        return knowledge_base
+
+    def _evict_over_budget(self, keep: str) -> List:
+        """Drop least recently used corpora until the resident total fits the budget (caller holds the lock)"""
+        evicted = []
+        while self._resident_bytes() > self.memory_budget_bytes:
+            victim = next((name for name in self.resident if name != keep), None)
+            if victim is None:
+                break  # Only the corpus just loaded is left - it stays even if it alone exceeds the budget
+            entry = self.resident.pop(victim)
+            self.stats["evictions"] += 1
+            self.stats["evicted_bytes"] += entry["bytes"]
+            evicted.append((victim, entry["manager"]))
+        return evicted
+
+    def _resident_bytes(self) -> int:
+        default_bytes = self.default.current.memory_bytes() if self.default.current else 0
+        return default_bytes + sum(entry["bytes"] for entry in self.resident.values())
+
+    def evict(self, name: str) -> bool:
+        """Unload a named knowledge base (the default cannot be evicted)"""
+        with self._lock:
+            entry = self.resident.pop(name, None)
+            if entry is None:
+                return False
+            self.stats["evictions"] += 1
+            self.stats["evicted_bytes"] += entry["bytes"]
+        entry["manager"].retire()
+        return True
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            resident = [{
+                "name": name,
+                "bytes": entry["bytes"],
+                "rows": len(entry["manager"].current),
+                "generation_id": entry["manager"].current.generation_id,
+                "loaded_at": entry["loaded_at"],
+                "load_seconds": entry["load_seconds"],
+                "hits": entry["hits"]
+            } for name, entry in self.resident.items()]
+            return {
+                "available": self.names(),
+                "resident": resident,
+                "resident_bytes": self._resident_bytes(),
+                "memory_budget_bytes": self.memory_budget_bytes,
+                **self.stats
+            }
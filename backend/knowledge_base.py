@@ -0,0 +1,415 @@
+import os
+import re
+import time
+import uuid
+import pickle
+import sys
+import shutil
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+from typing import Dict, List, Optional
+from corpus_store import CorpusStore
+from sharding import ShardedSearcher
+
+
+def preprocess_text(text: str) -> str:
+    """Simple text preprocessing"""
+    text = re.sub(r'\s+', ' ', text.strip())
+    text = text.replace('"', '').replace("'", "")
+    return text.lower()
+
+
+class KnowledgeBase:
+    """One generation of the searchable corpus: the corpus store plus its TF-IDF vectors.
+
+    A generation is immutable once loaded, so requests holding a reference keep
+    a consistent view while a newer generation is built and swapped in.
+    """
+
+    def __init__(self, csv_path: str, artifact_dir: str = ".", dedup_threshold: Optional[float] = 0.8,
+                 generation_id: Optional[str] = None, num_shards: int = 1):
+        self.csv_path = csv_path
+        self.artifact_dir = artifact_dir
+        self.dedup_threshold = dedup_threshold  # Answer similarity for collapsing near-duplicates (None disables)
+        self.generation_id = generation_id or "initial"
+        self.num_shards = num_shards  # > 1 scatters searches across shard worker processes
+        self.store_file = os.path.join(artifact_dir, "corpus_store.bin")
+        self.vectors_file = os.path.join(artifact_dir, "question_vectors.pkl")
+        self.vectorizer = TfidfVectorizer(
+            max_features=5000,
+            stop_words='english',
+            ngram_range=(1, 2),
+            lowercase=True
+        )
+        self.store = None  # Columnar, memory-mapped corpus - pandas is only used to build it
+        self.question_vectors = None
+        self.dedup_stats = None
+        self.searcher = None
+        self.loaded_at = None
+        self._readers = 0  # Requests currently pinned to this generation
+        self._retired = False
+        self._reader_lock = threading.Lock()
+
+    def load(self, force_rebuild: bool = False):
+        """Load (or build) the corpus store and vectors"""
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        self.load_data(force_rebuild)
+        self.generate_vectors(force_rebuild)
+        if self.num_shards > 1:
+            self.searcher = ShardedSearcher(self.question_vectors, os.path.join(self.artifact_dir, "shards"), self.num_shards)
+            self.question_vectors = None  # The shards own the matrix now - the API process keeps no full copy
+            print(f"Started {self.num_shards} retrieval shard workers")
+        self.loaded_at = time.time()
+        return self
+
+    def get_source_info(self) -> Dict:
+        """Identity of the corpus source, used to tell whether built artifacts are stale"""
+        stat = os.stat(self.csv_path)
+        return {
+            "csv": os.path.basename(self.csv_path),
+            "size": stat.st_size,
+            "mtime": int(stat.st_mtime),
+            "dedup_threshold": self.dedup_threshold
+        }
+
+    def load_data(self, force_rebuild: bool = False):
+        """Load the corpus store, building it from the CSV when it is missing or stale"""
+        source_info = self.get_source_info()
+        if os.path.exists(self.store_file) and not force_rebuild:
+            try:
+                store = CorpusStore.load(self.store_file)
+                if store.metadata.get("source") == source_info:
+                    self.store = store
+                    self.dedup_stats = store.metadata.get("dedup")
+                    print(f"Loaded corpus store with {len(self.store)} Q&A entries")
+                    return
+                print("Corpus store is stale, rebuilding...")
+            except (OSError, ValueError) as e:
+                print(f"Could not open corpus store, rebuilding: {e}")
+
+        self.build_store(source_info)
+
+    def build_store(self, source_info: Dict):
+        """Load the CSV data and pack it into the corpus store"""
+        # pandas and the dedup stage are only needed at build time
+        import pandas as pd
+        from dedup import collapse_near_duplicates
+
+        print("Loading first aid dataset...")
+        df = pd.read_csv(self.csv_path)
+
+        # Clean the data
+        df['question'] = df['question'].apply(preprocess_text)
+        df['answer'] = df['answer'].apply(preprocess_text)
+
+        print(f"Loaded {len(df)} Q&A pairs")
+
+        # Collapse near-duplicate Q&A pairs into canonical entries with alias questions
+        if self.dedup_threshold is not None:
+            df, self.dedup_stats = collapse_near_duplicates(df, threshold=self.dedup_threshold)
+            print(f"Collapsed near-duplicates: {self.dedup_stats['original_rows']} -> {self.dedup_stats['collapsed_rows']} entries "
+                  f"({self.dedup_stats['reduction_pct']}% smaller, {self.dedup_stats['groups_merged']} groups merged)")
+
+        self.store = CorpusStore.from_dataframe(df, metadata={"source": source_info, "dedup": self.dedup_stats})
+        try:
+            self.store.save(self.store_file)
+            # Serve from the memory-mapped file rather than the build-time copy
+            self.store = CorpusStore.load(self.store_file)
+            print(f"Corpus store saved to {self.store_file}")
+        except OSError as e:
+            print(f"Could not save corpus store, serving from memory: {e}")
+
+    def generate_vectors(self, force_regenerate: bool = False):
+        """Generate TF-IDF vectors for all questions"""
+        if os.path.exists(self.vectors_file) and not force_regenerate:
+            print("Loading cached vectors...")
+            with open(self.vectors_file, 'rb') as f:
+                data = pickle.load(f)
+                self.question_vectors = data['vectors']
+                self.vectorizer = data['vectorizer']
+
+            # Cached vectors from a different corpus (edited CSV, dedup settings) are stale
+            if data.get('source') != self.store.metadata.get('source') or self.question_vectors.shape[0] != len(self.store):
+                print("Cached vectors do not match the corpus, regenerating...")
+                return self.generate_vectors(force_regenerate=True)
+        else:
+            print("Generating TF-IDF vectors for questions...")
+            # Canonical question plus its aliases, so every phrasing still matches
+            questions = [self.store.search_text(i) for i in range(len(self.store))]
+            self.question_vectors = self.vectorizer.fit_transform(questions)
+
+            # Cache vectors for faster startup next time
+            with open(self.vectors_file, 'wb') as f:
+                pickle.dump({
+                    'vectors': self.question_vectors,
+                    'vectorizer': self.vectorizer,
+                    'source': self.store.metadata.get('source')
+                }, f)
+            print("Vectors cached for future use")
+
+    def vectorize(self, query: str):
+        """Sparse TF-IDF vector of a query in this generation's vocabulary"""
+        return self.vectorizer.transform([preprocess_text(query)])
+
+    def search(self, query: str, top_k: int = 3) -> List[Dict]:
+        """Find the most similar questions to the user query"""
+        return self.search_vector(self.vectorize(query), top_k)
+
+    def search_vector(self, query_vector, top_k: int = 3) -> List[Dict]:
+        """Find the most similar questions to an already vectorized query"""
+        if self.searcher is None and self.question_vectors is None:
+            # cosine_similarity(x, None) compares x with itself - never let that pass as a search
+            raise RuntimeError(f"Knowledge base generation {self.generation_id} has no vectors loaded")
+        if self.searcher is not None:
+            try:
+                matches = self.searcher.search(query_vector, top_k)
+            except Exception as e:
+                print(f"Sharded search failed, searching the mapped shards in-process: {e}")
+                matches = self.searcher.search_local(query_vector, top_k)
+        else:
+            similarities = cosine_similarity(query_vector, self.question_vectors)[0]
+            top_indices = np.argsort(similarities)[::-1][:top_k]
+            matches = [(float(similarities[idx]), int(idx)) for idx in top_indices]
+
+        results = []
+        for similarity, idx in matches:
+            results.append({
+                'question': self.store.question(idx),
+                'answer': self.store.answer(idx),
+                'similarity': similarity,
+                'index': idx,
+                'aliases': self.store.aliases(idx)
+            })
+
+        return results
+
+    def acquire(self) -> "KnowledgeBase":
+        """Pin this generation for a request; pair with release()"""
+        with self._reader_lock:
+            self._readers += 1
+        return self
+
+    def release(self):
+        """Unpin after a request - the last reader of a retired generation closes it"""
+        with self._reader_lock:
+            self._readers -= 1
+            close_now = self._retired and self._readers == 0
+        if close_now:
+            self.close()
+
+    def retire(self):
+        """No longer served: close now if nobody holds it, otherwise when the last reader releases it"""
+        with self._reader_lock:
+            self._retired = True
+            close_now = self._readers == 0
+        if close_now:
+            self.close()
+
+    def close(self):
+        """Stop the shard workers once this generation is no longer served (it stays searchable in-process)"""
+        if self.searcher is not None:
+            self.searcher.close()
+
+    def __len__(self) -> int:
+        return len(self.store) if self.store is not None else 0
+
+    def memory_bytes(self) -> int:
+        """Approximate memory held by this generation: vectors, vocabulary and corpus store"""
+        total = 0
+        if self.question_vectors is not None:
+            total += sum(getattr(self.question_vectors, name).nbytes for name in ("data", "indices", "indptr"))
+        elif self.searcher is not None:
+            total += self.searcher.matrix_bytes
+        vocabulary = getattr(self.vectorizer, "vocabulary_", None)
+        if vocabulary:
+            total += sys.getsizeof(vocabulary) + sum(sys.getsizeof(term) + sys.getsizeof(i) for term, i in vocabulary.items())
+            total += self.vectorizer.idf_.nbytes
+        if self.store is not None:
+            total += self.store.get_stats()["total_bytes"]
+        return total
+
+    def get_stats(self) -> Dict:
+        return {
+            "generation_id": self.generation_id,
+            "rows": len(self),
+            "loaded_at": self.loaded_at,
+            "readers": self._readers,
+            "source": self.store.metadata.get("source") if self.store is not None else None,
+            "shards": self.searcher.get_stats() if self.searcher is not None else None
+        }
+
+
+def build_generation_artifacts(csv_path: str, artifact_dir: str, dedup_threshold: Optional[float]) -> Dict:
+    """Build a generation's store and vectors on disk (runs in a child process during rebuilds)"""
+    knowledge_base = KnowledgeBase(csv_path, artifact_dir, dedup_threshold)
+    knowledge_base.load(force_rebuild=True)
+    return knowledge_base.get_stats()
+
+
+class GenerationManager:
+    """Blue/green generations of the knowledge base with atomic hot swap and rollback.
+
+    Readers take `current` once per request and keep that reference, so in-flight
+    requests finish on the generation they started with. A rebuild writes a complete
+    new generation into its own directory in a child process, loads it, and only
+    then swaps it in. The previous generation is kept loaded for instant rollback.
+    """
+
+    POINTER_FILE = "CURRENT"
+
+    def __init__(self, csv_path: str, root_dir: str = "kb_generations", dedup_threshold: Optional[float] = 0.8,
+                 use_subprocess: bool = True, num_shards: int = 1):
+        self.csv_path = csv_path
+        self.root_dir = root_dir
+        self.dedup_threshold = dedup_threshold
+        self.num_shards = num_shards
+        self.use_subprocess = use_subprocess
+        self.current = None
+        self.previous = None
+        self._swap_lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self.status = {"state": "idle", "generation_id": None, "started_at": None, "finished_at": None,
+                       "duration_seconds": None, "error": None}
+
+    def new_generation_id(self) -> str:
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+    def load_initial(self) -> KnowledgeBase:
+        """Load the generation recorded in the pointer file, or build the first one"""
+        generation_id = None
+        pointer_path = os.path.join(self.root_dir, self.POINTER_FILE)
+        if os.path.exists(pointer_path):
+            # Line 1: generation id, line 2: the CSV it was built from (a rebuild may have switched corpora)
+            with open(pointer_path) as f:
+                lines = f.read().splitlines()
+            generation_id = lines[0].strip() if lines and lines[0].strip() else None
+            csv_path = lines[1].strip() if len(lines) > 1 else ""
+            if generation_id and csv_path and csv_path != self.csv_path:
+                if os.path.isfile(csv_path):
+                    print(f"Generation {generation_id} was built from {csv_path}, serving that corpus")
+                    self.csv_path = csv_path
+                else:
+                    print(f"Corpus {csv_path} of generation {generation_id} is missing, falling back to {self.csv_path}")
+        if not generation_id:
+            generation_id = self.new_generation_id()
+
+        knowledge_base = KnowledgeBase(self.csv_path, os.path.join(self.root_dir, generation_id),
+                                       self.dedup_threshold, generation_id, self.num_shards)
+        knowledge_base.load()
+        self.activate(knowledge_base)
+        return knowledge_base
+
+    def activate(self, knowledge_base: KnowledgeBase):
+        """Atomically make a loaded generation current, keeping the old one for rollback"""
+        retired = None
+        with self._swap_lock:
+            if self.current is not None and self.current.generation_id != knowledge_base.generation_id:
+                retired = self.previous
+                self.previous = self.current
+            self.current = knowledge_base
+            self._write_pointer(knowledge_base)
+        if retired is not None:
+            # Requests that pinned it keep using it; its workers stop when the last one finishes
+            retired.retire()
+        print(f"Knowledge base generation {knowledge_base.generation_id} is now serving ({len(knowledge_base)} entries)")
+        self._prune()
+
+    def acquire(self) -> KnowledgeBase:
+        """Pin the serving generation for a request (release() it when done)"""
+        with self._swap_lock:
+            return self.current.acquire()
+
+    def rollback(self) -> bool:
+        """Swap back to the previous generation"""
+        with self._swap_lock:
+            if self.previous is None:
+                return False
+            self.current, self.previous = self.previous, self.current
+            self.csv_path = self.current.csv_path
+            self._write_pointer(self.current)
+        print(f"Rolled back to knowledge base generation {self.current.generation_id}")
+        return True
+
+    def start_rebuild(self, csv_path: Optional[str] = None) -> bool:
+        """Build a new generation in the background; False if a rebuild is already running"""
+        if not self._rebuild_lock.acquire(blocking=False):
+            return False
+        generation_id = self.new_generation_id()
+        self.status = {"state": "building", "generation_id": generation_id, "started_at": time.time(),
+                       "finished_at": None, "duration_seconds": None, "error": None}
+        thread = threading.Thread(target=self._rebuild, args=(generation_id, csv_path or self.csv_path),
+                                  name="kb-rebuild", daemon=True)
+        thread.start()
+        return True
+
+    def _rebuild(self, generation_id: str, csv_path: str):
+        artifact_dir = os.path.join(self.root_dir, generation_id)
+        try:
+            if self.use_subprocess:
+                # Building in a child process keeps the CPU-heavy work off the serving process's GIL
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    executor.submit(build_generation_artifacts, csv_path, artifact_dir, self.dedup_threshold).result()
+            else:
+                build_generation_artifacts(csv_path, artifact_dir, self.dedup_threshold)
+
+            # Loading the finished artifacts is cheap - the store is memory-mapped
+            knowledge_base = KnowledgeBase(csv_path, artifact_dir, self.dedup_threshold, generation_id, self.num_shards)
+            knowledge_base.load()
+            if len(knowledge_base) == 0 or not knowledge_base.search("first aid", top_k=1):
+                knowledge_base.close()
+                raise ValueError("New generation is empty")
+
+            self.csv_path = csv_path
+            self.activate(knowledge_base)
+            self.status.update({"state": "ready", "error": None})
+        except Exception as e:
+            print(f"Knowledge base rebuild {generation_id} failed, still serving the current generation: {e}")
+            self.status.update({"state": "failed", "error": str(e)})
+            shutil.rmtree(artifact_dir, ignore_errors=True)
+        finally:
+            self.status["finished_at"] = time.time()
+            self.status["duration_seconds"] = round(self.status["finished_at"] - self.status["started_at"], 2)
+            self._rebuild_lock.release()
+
+    def _write_pointer(self, knowledge_base: KnowledgeBase):
+        os.makedirs(self.root_dir, exist_ok=True)
+        pointer_path = os.path.join(self.root_dir, self.POINTER_FILE)
+        with open(f"{pointer_path}.tmp", "w") as f:
+            f.write(f"{knowledge_base.generation_id}\n{knowledge_base.csv_path}\n")
+        os.replace(f"{pointer_path}.tmp", pointer_path)
+
+    def _prune(self):
+        """Remove generation directories other than current, previous and one being built"""
+        keep = {kb.generation_id for kb in (self.current, self.previous) if kb is not None}
+        if self.status.get("state") == "building":
+            keep.add(self.status.get("generation_id"))
+        for name in os.listdir(self.root_dir):
+            path = os.path.join(self.root_dir, name)
+            if os.path.isdir(path) and name not in keep:
+                # Memory-mapped files stay valid for in-flight readers after unlinking
+                shutil.rmtree(path, ignore_errors=True)
+
+    def retire(self):
+        """Stop serving this corpus: each loaded generation closes once its in-flight requests finish"""
+        with self._swap_lock:
+            generations = [kb for kb in (self.current, self.previous) if kb is not None]
+        for knowledge_base in generations:
+            knowledge_base.retire()
+
+    def close(self):
+        """Release the loaded generations (stops their shard workers)"""
+        with self._swap_lock:
+            generations = [kb for kb in (self.current, self.previous) if kb is not None]
+        for knowledge_base in generations:
+            knowledge_base.close()
+
+    def get_status(self) -> Dict:
+        return {
+            "current": self.current.get_stats() if self.current else None,
+            "previous": self.previous.get_stats() if self.previous else None,
+            "rebuild": dict(self.status)
+        }
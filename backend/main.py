@@ -1,11 +1,18 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Header, HTTPException, Depends
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional
 import requests
 import os
+import uuid
+import hmac
 from dotenv import load_dotenv
 load_dotenv()
 from fastapi.middleware.cors import CORSMiddleware
+from tracing import tracer, profiler
+from attachments import (AttachmentError, AttachmentTooLarge, AttachmentReader, read_base64_attachment,
+                         is_anonymous_session, MAX_ATTACHMENTS_PER_REQUEST, MAX_REQUEST_BYTES)
 
 app = FastAPI()
 app.add_middleware(
@@ -16,11 +23,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    """Reject oversized /ask bodies before pydantic parses the attachments into memory"""
+    if request.url.path == "/ask" and request.method == "POST":
+        content_length = request.headers.get("content-length")
+        # A chunked body has no length to check up front - the server enforces a declared length, so require one
+        if not content_length or not content_length.isdigit():
+            return JSONResponse(status_code=411, content={
+                "error": "Content-Length required",
+                "textResponse": "Your request could not be processed. Please try again."
+            })
+        if int(content_length) > MAX_REQUEST_BYTES:
+            return JSONResponse(status_code=413, content={
+                "error": f"Request too large (limit {MAX_REQUEST_BYTES} bytes)",
+                "textResponse": "Your attachments are too large. Please upload smaller files."
+            })
+    return await call_next(request)
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Admin endpoints are off unless ADMIN_TOKEN is set, and then need it in the X-Admin-Token header"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (set ADMIN_TOKEN to enable them)")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
 # Initialize the enhanced RAG system with Ollama
 print("Initializing Enhanced First Aid RAG system with Ollama...")
 try:
     from enhanced_rag import EnhancedFirstAidRAG
-    first_aid_rag = EnhancedFirstAidRAG(ollama_host=os.getenv("OLLAMA_HOST", "ollama:11434"))
+    first_aid_rag = EnhancedFirstAidRAG(ollama_host=os.getenv("OLLAMA_HOST", "ollama:11434"),
+                                        num_shards=int(os.getenv("RETRIEVAL_SHARDS", "1")))
     rag_initialized = first_aid_rag.initialize()
     if rag_initialized:
         print("✅ Enhanced RAG system initialized successfully!")
@@ -54,6 +89,7 @@ class ChatRequest(BaseModel):
     attachments: Optional[List[Attachment]] = []
     reset: Optional[bool] = False
     profile: Optional[ProfileInfo] = None
+    knowledgeBase: Optional[str] = None  # Named corpus (language, region, audience); None uses the default
 
 @app.post("/ask")
 async def ask_question(payload: ChatRequest):
@@ -63,6 +99,12 @@ async def ask_question(payload: ChatRequest):
             "error": "Local RAG system is not available",
             "textResponse": "The local AI system is currently unavailable. Please use the external AI option or try again later."
         }
+
+    if not first_aid_rag.registry.has(payload.knowledgeBase):
+        return {
+            "error": f"Unknown knowledge base: {payload.knowledgeBase}",
+            "textResponse": f"Unknown knowledge base. Available: {', '.join(first_aid_rag.registry.names())}"
+        }
     
     try:
         # Convert profile to dict if provided
@@ -89,9 +131,30 @@ async def ask_question(payload: ChatRequest):
             profile_id = payload.sessionId
             print(f"Using profile ID from sessionId: {profile_id}")
         
+        # Index attachments into the session's ephemeral index off the event loop
+        attachment_results = []
+        for position, attachment in enumerate(payload.attachments or []):
+            if position >= MAX_ATTACHMENTS_PER_REQUEST:
+                attachment_results.append({"name": attachment.name, "status": "error",
+                                           "message": f"Only {MAX_ATTACHMENTS_PER_REQUEST} attachments are allowed per request"})
+                continue
+            attachment_results.append(await ingest_attachment(profile_id, attachment))
+            attachment.contentString = ""  # Release the base64 blob before the LLM call
+        
         print(f"Calling get_answer with profile_id: {profile_id}, profile_dict: {profile_dict}")
         
-        result = first_aid_rag.get_answer(payload.message, profile_dict, profile_id)
+        request_id = uuid.uuid4().hex
+        with tracer.request(request_id, payload.sessionId, name="ask"):
+            # A first use of a named corpus loads (or builds) it - keep that off the event loop
+            with tracer.span("load_knowledge_base", knowledge_base=payload.knowledgeBase or "default"):
+                knowledge_base = await run_in_threadpool(first_aid_rag.registry.acquire, payload.knowledgeBase)
+            try:
+                # Retrieval and generation block - run them in the threadpool so concurrent requests overlap on the shards.
+                # The profiler is entered on that worker thread, which is the one doing the work
+                result = await run_in_threadpool(profiler.call, f"ask:{request_id}", first_aid_rag.get_answer,
+                                                 payload.message, profile_dict, profile_id, knowledge_base=knowledge_base)
+            finally:
+                knowledge_base.release()
         
         return {
             "textResponse": result["answer"],
@@ -99,7 +162,11 @@ async def ask_question(payload: ChatRequest):
             "confidence": result["confidence"],
             "type": "enhanced_local_rag",
             "method": result.get("method", "unknown"),
-            "similar_questions": result.get("similar_questions", [])
+            "similar_questions": result.get("similar_questions", []),
+            "prompt_tokens": result.get("prompt_tokens"),
+            "requestId": request_id,
+            "knowledgeBase": payload.knowledgeBase or "default",
+            "attachments": attachment_results
         }
         
     except Exception as e:
@@ -108,6 +175,52 @@ async def ask_question(payload: ChatRequest):
             "textResponse": "I'm sorry, there was an error processing your question. Please try again."
         }
 
+async def ingest_attachment(session_id: str, attachment: Attachment) -> dict:
+    """Decode, chunk and index one base64 attachment for a session"""
+    if is_anonymous_session(session_id):
+        # Every anonymous user is "guest" - indexing there would show one user's documents to all of them
+        return {"name": attachment.name, "status": "error", "message": "Attachments need a unique sessionId"}
+    try:
+        chunks = await run_in_threadpool(read_base64_attachment, attachment.name, attachment.mime, attachment.contentString)
+        total_chunks = await run_in_threadpool(first_aid_rag.session_indexes.add, session_id, attachment.name, chunks)
+        return {"name": attachment.name, "status": "indexed", "chunks": len(chunks), "session_chunks": total_chunks}
+    except AttachmentError as e:
+        return {"name": attachment.name, "status": "error", "message": str(e)}
+
+@app.post("/attachments")
+async def upload_attachment(request: Request, sessionId: str, name: str = "attachment", mime: Optional[str] = None):
+    """Stream a raw (not base64) attachment into the session's index without buffering the whole upload"""
+    if not first_aid_rag or not rag_initialized:
+        return {
+            "status": "error",
+            "message": "Local RAG system is not available"
+        }
+
+    if is_anonymous_session(sessionId):
+        return JSONResponse(status_code=400, content={
+            "status": "error",
+            "message": "Attachments need a unique sessionId"
+        })
+    
+    try:
+        reader = AttachmentReader(name, mime or request.headers.get("content-type", "text/plain"))
+        async for data in request.stream():
+            reader.feed(data)
+        chunks = await run_in_threadpool(reader.finish)
+        total_chunks = await run_in_threadpool(first_aid_rag.session_indexes.add, sessionId, name, chunks)
+        return {
+            "status": "success",
+            "name": name,
+            "bytes": reader.total_bytes,
+            "chunks": len(chunks),
+            "session_chunks": total_chunks
+        }
+    except AttachmentError as e:
+        return JSONResponse(status_code=413 if isinstance(e, AttachmentTooLarge) else 400, content={
+            "status": "error",
+            "message": str(e)
+        })
+
 @app.post("/ask-rag-only")
 async def ask_rag_only(payload: ChatRequest):
     """RAG-only endpoint - uses simple RAG system without LLM enhancement"""
@@ -116,10 +229,21 @@ async def ask_rag_only(payload: ChatRequest):
             "error": "Local RAG system is not available",
             "textResponse": "The local AI system is currently unavailable. Please try again later."
         }
+
+    if not first_aid_rag.registry.has(payload.knowledgeBase):
+        return {
+            "error": f"Unknown knowledge base: {payload.knowledgeBase}",
+            "textResponse": f"Unknown knowledge base. Available: {', '.join(first_aid_rag.registry.names())}"
+        }
     
     try:
         # For RAG-only mode, use the enhanced RAG system but skip Ollama
-        similar_questions = first_aid_rag.search_similar_questions(payload.message, top_k=1)
+        knowledge_base = await run_in_threadpool(first_aid_rag.registry.acquire, payload.knowledgeBase)
+        try:
+            similar_questions = await run_in_threadpool(first_aid_rag.search_similar_questions, payload.message,
+                                                        top_k=1, knowledge_base=knowledge_base)
+        finally:
+            knowledge_base.release()
         
         if similar_questions and similar_questions[0]['similarity'] > 0.1:
             best_match = similar_questions[0]
@@ -174,13 +298,20 @@ async def health_check():
     except Exception as e:
         ollama_status = f"error: {str(e)}"
     
+    knowledge_base = first_aid_rag.knowledge_base if first_aid_rag else None
     return {
         "status": "healthy",
         "rag_loaded": rag_initialized and first_aid_rag is not None,
-        "total_qa_pairs": len(first_aid_rag.df) if first_aid_rag and first_aid_rag.df is not None else 0,
+        "total_qa_pairs": len(knowledge_base) if knowledge_base else 0,
+        "corpus_store": knowledge_base.store.get_stats() if knowledge_base else None,
+        "corpus_dedup": knowledge_base.dedup_stats if knowledge_base else None,
+        "knowledge_base": first_aid_rag.generations.get_status() if first_aid_rag else None,
+        "knowledge_bases": first_aid_rag.registry.get_stats() if first_aid_rag else None,
         "ollama_status": ollama_status,
         "available_models": available_models,
         "selected_model": selected_model,
+        "generation_policy": first_aid_rag.generation_policy.get_stats() if first_aid_rag else [],
+        "session_attachments": first_aid_rag.session_indexes.get_stats() if first_aid_rag else None,
         "enhanced_mode": rag_initialized and len(available_models) > 0
     }
 
@@ -230,4 +361,93 @@ async def get_conversation_summary(sessionId: str = "guest"):
         return {
             "status": "error",
             "message": f"Error getting conversation summary: {str(e)}"
-        }
\ No newline at end of file
+        }
+
+class ProfilerConfigRequest(BaseModel):
+    sample_rate_pct: Optional[float] = None
+    interval_ms: Optional[float] = None
+    max_profiles_per_minute: Optional[int] = None
+
+@app.get("/admin/profiler", dependencies=[Depends(require_admin)])
+async def get_profiler_status():
+    """Sampling profiler settings and the hottest frames seen so far"""
+    return {
+        "status": "success",
+        "trace_file": tracer.trace_file if tracer.enabled else None,
+        **profiler.get_status()
+    }
+
+@app.post("/admin/profiler", dependencies=[Depends(require_admin)])
+async def configure_profiler(request: ProfilerConfigRequest):
+    """Turn the sampling profiler on for a percentage of /ask requests (0 switches it off)"""
+    try:
+        status = profiler.configure(request.sample_rate_pct, request.interval_ms, request.max_profiles_per_minute)
+        return {
+            "status": "success",
+            **status
+        }
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": f"Error configuring profiler: {str(e)}"
+        }
+
+class RebuildRequest(BaseModel):
+    csv_path: Optional[str] = None
+
+@app.post("/admin/rebuild", dependencies=[Depends(require_admin)])
+async def rebuild_knowledge_base(request: RebuildRequest):
+    """Build a new knowledge base generation in the background and hot-swap it in when ready"""
+    if not first_aid_rag or not rag_initialized:
+        return {
+            "status": "error",
+            "message": "Local RAG system is not available"
+        }
+    
+    csv_path = None
+    if request.csv_path:
+        # Only corpora next to the service can be loaded
+        csv_path = os.path.basename(request.csv_path)
+        if not os.path.isfile(csv_path):
+            return {
+                "status": "error",
+                "message": f"Corpus file not found: {csv_path}"
+            }
+    
+    if not first_aid_rag.generations.start_rebuild(csv_path):
+        return {
+            "status": "info",
+            "message": "A rebuild is already in progress",
+            **first_aid_rag.generations.get_status()
+        }
+    return {
+        "status": "success",
+        "message": "Rebuild started - the current generation keeps serving until the new one is ready",
+        **first_aid_rag.generations.get_status()
+    }
+
+@app.post("/admin/rollback", dependencies=[Depends(require_admin)])
+async def rollback_knowledge_base():
+    """Switch back to the previous knowledge base generation"""
+    if not first_aid_rag or not first_aid_rag.generations.rollback():
+        return {
+            "status": "info",
+            "message": "No previous generation to roll back to"
+        }
+    return {
+        "status": "success",
+        **first_aid_rag.generations.get_status()
+    }
+
+@app.get("/admin/knowledge-base", dependencies=[Depends(require_admin)])
+async def get_knowledge_base_status():
+    """Serving and previous generations plus the state of the last rebuild"""
+    if not first_aid_rag:
+        return {
+            "status": "info",
+            "message": "Local RAG system is not available"
+        }
+    return {
+        "status": "success",
+        **first_aid_rag.generations.get_status()
+    }
@@ -0,0 +1,215 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Prompt token budgets per model family - smaller models on CPU pay the most for long prefill
+MODEL_TOKEN_BUDGETS = {
+    "qwen2": 384,
+    "gemma": 384,
+    "phi3": 448,
+    "mistral": 640,
+    "llama2": 640,
+}
+DEFAULT_TOKEN_BUDGET = 448
+MIN_CONTEXT_TOKENS = 64  # Always leave room for some grounding material
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\\n|\n")
+_STOP_WORDS = {
+    "a", "an", "the", "and", "or", "but", "if", "of", "to", "in", "on", "for", "with", "is", "are",
+    "was", "be", "it", "its", "this", "that", "my", "your", "you", "i", "me", "do", "does", "what",
+    "how", "should", "can", "when", "who", "has", "have", "he", "she", "they", "them", "his", "her",
+    "at", "by", "as", "from", "so", "not", "no", "about", "someone", "previous", "conversation",
+    "context", "current", "question", "q"
+}
+
+HTML_FORMAT_RULES = ("Format the answer as valid HTML: <h3> headings, <ol>/<ul> for steps, "
+                     "<strong> for warnings, <p> for paragraphs, <em> for emphasis.")
+PRIVACY_RULE = ("IMPORTANT: Do NOT mention or repeat any patient information (age, gender, blood group, "
+                "conditions); use it only to tailor your advice.")
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate the LLM token count of a text (words and punctuation, plus subword overhead)"""
+    if not text:
+        return 0
+    pieces = _TOKEN_PATTERN.findall(text)
+    return int(len(pieces) * 1.15) + 1
+
+
+def get_token_budget(model: str) -> int:
+    """Get the prompt token budget for a model"""
+    model_lower = (model or "").lower()
+    for family, budget in MODEL_TOKEN_BUDGETS.items():
+        if family in model_lower:
+            return budget
+    return DEFAULT_TOKEN_BUDGET
+
+
+def content_terms(text: str) -> set:
+    """Lowercased content words of a text, without stop words (plurals folded to singular)"""
+    terms = set()
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in _STOP_WORDS or len(word) < 2:
+            continue
+        terms.add(word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word)
+    return terms
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split an answer into sentences (the corpus uses literal \\n between sections)"""
+    return [s.strip() for s in _SENTENCE_SPLIT.split(text) if s and s.strip()]
+
+
+def select_context_sentences(query: str, similar_questions: List[Dict], token_budget: int, top_k: int = 3) -> Tuple[str, int]:
+    """Extractively pick the retrieved sentences that overlap the query most, within a token budget.
+
+    Sentences are ranked by query term overlap weighted by the similarity of the
+    match they came from, then emitted in their original order so each source
+    answer still reads naturally.
+    """
+    query_terms = content_terms(query)
+    best_similarity = similar_questions[0].get('similarity', 0.0) if similar_questions else 0.0
+    # Query terms the best match agrees on - keeps secondary matches on the same topic
+    topic_terms = (query_terms & content_terms(similar_questions[0].get('question', ''))) if similar_questions else set()
+    topic_terms = topic_terms or query_terms
+    candidates = []
+    for doc_rank, match in enumerate(similar_questions[:top_k]):
+        doc_weight = max(match.get('similarity', 0.0), 0.01)
+        # Weak secondary matches tend to drag in off-topic sentences
+        if doc_rank > 0 and doc_weight < 0.5 * best_similarity:
+            continue
+        question_terms = content_terms(match.get('question', ''))
+        for position, sentence in enumerate(split_sentences(match.get('answer', ''))):
+            terms = content_terms(sentence)
+            if not terms:
+                continue
+            overlap = len(terms & query_terms) + 0.5 * len(terms & question_terms)
+            if doc_rank == 0:
+                # The best match is the core grounding - keep all of it in reading order when it fits
+                score = (overlap + (0.5 if position < 2 else 0.0)) * doc_weight + 0.01 / (1 + position)
+            elif terms & topic_terms or question_terms & topic_terms:
+                # Sentences of a secondary match count if they, or the question they answer, share the topic
+                score = (overlap + (0.5 if question_terms & topic_terms else 0.0)) * doc_weight
+            else:
+                continue
+            candidates.append((score, doc_rank, position, sentence))
+
+    selected = []
+    seen = set()
+    used_tokens = 0
+    for score, doc_rank, position, sentence in sorted(candidates, key=lambda c: (-c[0], c[1], c[2])):
+        # Related answers often share sentences word for word
+        if sentence in seen:
+            continue
+        sentence_tokens = estimate_tokens(sentence)
+        if used_tokens + sentence_tokens > token_budget:
+            continue
+        selected.append((doc_rank, position, sentence))
+        seen.add(sentence)
+        used_tokens += sentence_tokens
+
+    selected.sort()
+    return " ".join(sentence for _, _, sentence in selected), used_tokens
+
+
+def select_attachment_sentences(query: str, attachment_matches: List[Dict], token_budget: int) -> Tuple[str, int]:
+    """Pick the sentences of the user's attachment chunks that share terms with the query, within a token budget.
+
+    Attachment scores come from a tiny per-session index and are not comparable to
+    corpus similarities, so they only rank chunks against each other.
+    """
+    query_terms = content_terms(query)
+    candidates = []
+    for chunk_rank, match in enumerate(attachment_matches):
+        for position, sentence in enumerate(split_sentences(match.get('answer', ''))):
+            overlap = len(content_terms(sentence) & query_terms)
+            if overlap:
+                candidates.append((overlap * max(match.get('similarity', 0.0), 0.01), chunk_rank, position, sentence))
+
+    selected = []
+    used_tokens = 0
+    for score, chunk_rank, position, sentence in sorted(candidates, key=lambda c: (-c[0], c[1], c[2])):
+        sentence_tokens = estimate_tokens(sentence)
+        if used_tokens + sentence_tokens > token_budget:
+            continue
+        selected.append((chunk_rank, position, sentence))
+        used_tokens += sentence_tokens
+
+    selected.sort()
+    return " ".join(sentence for _, _, sentence in selected), used_tokens
+
+
+class PromptBuilder:
+    """Builds token-budgeted prompts for Ollama from the query, retrieved answers and profile"""
+
+    def __init__(self, budgets: Optional[Dict[str, int]] = None, top_k: int = 3):
+        self.budgets = budgets
+        self.top_k = top_k
+
+    def budget_for(self, model: str) -> int:
+        """Get the prompt token budget for a model, honouring any overrides"""
+        if self.budgets:
+            model_lower = (model or "").lower()
+            for family, budget in self.budgets.items():
+                if family in model_lower:
+                    return budget
+        return get_token_budget(model)
+
+    def build(self, query: str, similar_questions: List[Dict], model: str, profile_context: str = "",
+              attachment_matches: Optional[List[Dict]] = None) -> Dict:
+        """Build a grounded prompt (or an ungrounded one when there is nothing to ground on)"""
+        budget = self.budget_for(model)
+
+        if not similar_questions and not attachment_matches:
+            prompt = f"""You are a helpful first aid assistant. Give a clear, practical answer (150-200 words) with specific steps and safety information; advise immediate medical help for serious emergencies.
+
+{profile_context}Question: {query}
+
+{PRIVACY_RULE}
+{HTML_FORMAT_RULES}"""
+            prompt_tokens = estimate_tokens(prompt)
+            return {"prompt": prompt, "prompt_tokens": prompt_tokens, "context_tokens": 0, "budget": budget}
+
+        header = "You are a first aid assistant. Relevant knowledge base information:\n\n"
+        attachment_header = "\n\nRelevant excerpts from the user's own uploaded documents:\n\n"
+        footer = f"""
+
+{profile_context}Answer this question with clear, practical steps (150-200 words), using and expanding on the information above:
+
+{query}
+
+{PRIVACY_RULE}
+{HTML_FORMAT_RULES}"""
+        overhead = estimate_tokens(header) + estimate_tokens(footer)
+        if attachment_matches:
+            overhead += estimate_tokens(attachment_header)
+        context_budget = max(MIN_CONTEXT_TOKENS, budget - overhead)
+
+        # The user's documents get at most a third of the context - the knowledge base stays the main grounding
+        attachment_context, attachment_tokens = "", 0
+        if attachment_matches:
+            attachment_budget = context_budget if not similar_questions else context_budget // 3
+            attachment_context, attachment_tokens = select_attachment_sentences(query, attachment_matches, attachment_budget)
+
+        context, context_tokens = "", 0
+        if similar_questions:
+            context_budget -= attachment_tokens
+            context, context_tokens = select_context_sentences(query, similar_questions, context_budget, self.top_k)
+            if not context:
+                # Nothing fit whole - fall back to the head of the best match
+                context = similar_questions[0]['answer'][:context_budget * 4]
+                context_tokens = estimate_tokens(context)
+
+        if context:
+            prompt = f"{header}{context}"
+        else:
+            prompt = "You are a first aid assistant."
+        if attachment_context:
+            prompt += f"{attachment_header}{attachment_context}"
+        prompt += footer
+        return {
+            "prompt": prompt,
+            "prompt_tokens": estimate_tokens(prompt),
+            "context_tokens": context_tokens + attachment_tokens,
+            "budget": budget
+        }
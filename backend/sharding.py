@@ -0,0 +1,172 @@
+import os
+import time
+import heapq
+import threading
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix
+from typing import Dict, List, Tuple
+
+# The shard owned by this worker process (set by the pool initializer)
+_shard = None
+
+
+def open_shard(shard_dir: str, shard_id: int) -> Dict:
+    """Memory-map one shard's CSR arrays - pages are shared through the page cache, not copied"""
+    prefix = os.path.join(shard_dir, f"shard_{shard_id}")
+    data = np.load(f"{prefix}_data.npy", mmap_mode="r")
+    indices = np.load(f"{prefix}_indices.npy", mmap_mode="r")
+    indptr = np.load(f"{prefix}_indptr.npy", mmap_mode="r")
+    meta = np.load(f"{prefix}_meta.npy")  # [row offset, rows, vocabulary size]
+    return {
+        "matrix": csr_matrix((data, indices, indptr), shape=(int(meta[1]), int(meta[2])), copy=False),
+        "row_offset": int(meta[0])
+    }
+
+
+def score_shard(shard: Dict, query_indices: np.ndarray, query_data: np.ndarray, top_k: int) -> List[Tuple[float, int]]:
+    """Local top-k of one shard as (score, global row), best first"""
+    matrix = shard["matrix"]
+    query = csr_matrix((query_data, query_indices, [0, len(query_indices)]), shape=(1, matrix.shape[1]))
+    # Rows and query are L2-normalized, so the dot product is the cosine similarity
+    scores = np.asarray((matrix @ query.T).todense()).ravel()
+    k = min(top_k, len(scores))
+    if k == 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(float(scores[i]), int(i) + shard["row_offset"]) for i in top]
+
+
+def _load_shard(shard_dir: str, shard_id: int):
+    """Pool initializer - open this worker's shard"""
+    global _shard
+    _shard = open_shard(shard_dir, shard_id)
+
+
+def _search_shard(query_indices: np.ndarray, query_data: np.ndarray, top_k: int) -> Tuple[List[Tuple[float, int]], float]:
+    """Score the query against this worker's shard, timing the compute"""
+    start = time.perf_counter()
+    results = score_shard(_shard, query_indices, query_data, top_k)
+    return results, time.perf_counter() - start
+
+
+def merge_top_k(per_shard: List[List[Tuple[float, int]]], top_k: int) -> List[Tuple[float, int]]:
+    """K-way merge of per-shard lists sorted by descending score"""
+    merged = heapq.merge(*per_shard, key=lambda item: -item[0])
+    return [item for _, item in zip(range(top_k), merged)]
+
+
+def write_shards(question_vectors, shard_dir: str, num_shards: int) -> List[Tuple[int, int]]:
+    """Split the vectors into contiguous row ranges and save each as CSR arrays"""
+    os.makedirs(shard_dir, exist_ok=True)
+    matrix = csr_matrix(question_vectors)
+    matrix.sort_indices()
+    rows = matrix.shape[0]
+    bounds = np.linspace(0, rows, num_shards + 1).astype(int)
+    ranges = []
+    for shard_id in range(num_shards):
+        start, end = int(bounds[shard_id]), int(bounds[shard_id + 1])
+        shard = matrix[start:end]
+        prefix = os.path.join(shard_dir, f"shard_{shard_id}")
+        for name, array in (("data", shard.data), ("indices", shard.indices), ("indptr", shard.indptr),
+                            ("meta", np.array([start, end - start, matrix.shape[1]], dtype=np.int64))):
+            # Write then rename so a worker never maps a half-written file
+            tmp_path = f"{prefix}_{name}.tmp.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, f"{prefix}_{name}.npy")
+        ranges.append((start, end))
+    return ranges
+
+
+class ShardedSearcher:
+    """Scatter-gather retrieval over N shards, each owned by its own worker process.
+
+    A query is sent to every shard, each returns its local top-k, and the API
+    process k-way merges the sorted per-shard lists into the global top-k. The
+    API process never holds a copy of the matrix: it maps the shard files too
+    (pages are only read on use) and scores them itself if a worker fails or the
+    workers have been stopped. The mappings stay valid after the files are deleted.
+    """
+
+    def __init__(self, question_vectors, shard_dir: str, num_shards: int, timeout: float = 5.0, latency_window: int = 200):
+        self.shard_dir = shard_dir
+        self.num_shards = num_shards
+        self.timeout = timeout  # Deadline for the whole scatter, not per shard
+        self.ranges = write_shards(question_vectors, shard_dir, num_shards)
+        self.matrix_bytes = sum(getattr(question_vectors, name).nbytes for name in ("data", "indices", "indptr"))  # Mapped by the workers
+        context = multiprocessing.get_context("spawn")
+        self.executors = [
+            ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_load_shard, initargs=(shard_dir, shard_id))
+            for shard_id in range(num_shards)
+        ]
+        self.latencies = [deque(maxlen=latency_window) for _ in range(num_shards)]  # (compute, round trip) seconds
+        self.failures = [0] * num_shards
+        self.local_shards = [open_shard(shard_dir, shard_id) for shard_id in range(num_shards)]  # Fallback path
+        self.closed = False
+        self._lock = threading.Lock()
+        self.warm_up()
+
+    def warm_up(self):
+        """Start the workers and map their shards now rather than on the first real query"""
+        empty = np.array([], dtype=np.int32)
+        for future in [executor.submit(_search_shard, empty, empty.astype(np.float64), 1) for executor in self.executors]:
+            future.result()
+
+    def search(self, query_vector, top_k: int = 3) -> List[Tuple[float, int]]:
+        """Global top-k as (score, row) pairs, best first"""
+        if self.closed:
+            return self.search_local(query_vector, top_k)
+        query = csr_matrix(query_vector)
+        query.sort_indices()
+        submitted_at = time.perf_counter()
+        deadline = submitted_at + self.timeout
+        futures = [executor.submit(_search_shard, query.indices, query.data, top_k) for executor in self.executors]
+
+        per_shard = []
+        for shard_id, future in enumerate(futures):
+            try:
+                results, compute_seconds = future.result(timeout=max(0.0, deadline - time.perf_counter()))
+            except Exception:
+                with self._lock:
+                    self.failures[shard_id] += 1
+                raise
+            with self._lock:
+                self.latencies[shard_id].append((compute_seconds, time.perf_counter() - submitted_at))
+            per_shard.append(results)
+
+        return merge_top_k(per_shard, top_k)
+
+    def search_local(self, query_vector, top_k: int = 3) -> List[Tuple[float, int]]:
+        """Score every shard in this process from the memory-mapped files (fallback path)"""
+        query = csr_matrix(query_vector)
+        query.sort_indices()
+        return merge_top_k([score_shard(shard, query.indices, query.data, top_k) for shard in self.local_shards], top_k)
+
+    def get_stats(self) -> List[Dict]:
+        """Per-shard row range and latency percentiles"""
+        stats = []
+        with self._lock:
+            for shard_id, (start, end) in enumerate(self.ranges):
+                samples = list(self.latencies[shard_id])
+                compute = sorted(c for c, _ in samples)
+                round_trip = sorted(r for _, r in samples)
+                stats.append({
+                    "shard": shard_id,
+                    "rows": end - start,
+                    "queries": len(samples),
+                    "failures": self.failures[shard_id],
+                    "compute_p50_ms": round(1000 * compute[len(compute) // 2], 3) if compute else None,
+                    "compute_p95_ms": round(1000 * compute[int(0.95 * (len(compute) - 1))], 3) if compute else None,
+                    "round_trip_p50_ms": round(1000 * round_trip[len(round_trip) // 2], 3) if round_trip else None,
+                    "round_trip_p95_ms": round(1000 * round_trip[int(0.95 * (len(round_trip) - 1))], 3) if round_trip else None
+                })
+        return stats
+
+    def close(self):
+        """Stop the shard worker processes - searches after this run in-process on the mapped shards"""
+        self.closed = True
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,129 @@
+import base64
+import zlib
+import pytest
+import attachments
+from attachments import (AttachmentError, AttachmentReader, AttachmentTooLarge, SessionIndexStore, TextChunker,
+                         extract_pdf_text, iter_base64_decoded, max_base64_chars, read_base64_attachment,
+                         MAX_ATTACHMENT_BYTES, MAX_ATTACHMENTS_PER_REQUEST, MAX_REQUEST_BYTES)
+
+NOTES = "Patient was treated for a second degree burn on the left arm. Allergic to penicillin. "
+
+
+def make_pdf(*streams: bytes) -> bytes:
+    body = b"".join(b"1 0 obj\n<< /Filter /FlateDecode >>\nstream\n" + stream + b"\nendstream\nendobj\n" for stream in streams)
+    return b"%PDF-1.4\n" + body + b"%%EOF\n"
+
+
+@pytest.mark.parametrize("chunk_chars", [4, 7, 64, 64 * 1024])
+def test_base64_decodes_across_chunks_with_whitespace_and_prefix(chunk_chars):
+    data = NOTES.encode() * 20
+    wrapped = base64.encodebytes(data).decode().replace("\n", "\r\n")  # MIME-style line breaks
+    decoded = b"".join(iter_base64_decoded("data:text/plain;base64," + wrapped, chunk_chars=chunk_chars))
+    assert decoded == data
+
+
+def test_invalid_base64_is_rejected():
+    with pytest.raises(AttachmentError):
+        list(iter_base64_decoded("not base64!"))
+    with pytest.raises(AttachmentError):
+        list(iter_base64_decoded(base64.b64encode(b"abcd").decode()[:-1]))
+
+
+def test_chunker_overlaps_windows_and_flushes_the_tail():
+    chunker = TextChunker(chunk_words=5, overlap_words=2)
+    words = [f"w{i}" for i in range(11)]
+    chunks = chunker.feed(" ".join(words[:6]) + " ") + chunker.feed(" ".join(words[6:]))
+    assert chunks == ["w0 w1 w2 w3 w4", "w3 w4 w5 w6 w7"]
+    assert chunker.flush() == ["w6 w7 w8 w9 w10"]  # The partial last word is kept
+
+
+def test_flush_skips_a_tail_that_is_only_overlap():
+    chunker = TextChunker(chunk_words=5, overlap_words=2)
+    assert chunker.feed("a b c d e ") == ["a b c d e"]
+    assert chunker.flush() == []
+
+
+def test_words_split_across_feeds_stay_whole():
+    chunker = TextChunker(chunk_words=50)
+    for piece in ("bur", "n on the le", "", "ft arm"):
+        chunker.feed(piece)
+    assert chunker.flush() == ["burn on the left arm"]
+
+
+def test_multibyte_characters_split_across_pieces():
+    reader = AttachmentReader("notes.txt", "text/plain")
+    for byte in "naïve café résumé".encode():
+        reader.feed(bytes([byte]))
+    assert reader.finish() == ["naïve café résumé"]
+
+
+def test_attachment_size_limit():
+    content = base64.b64encode(b"x " * 600).decode()
+    with pytest.raises(AttachmentTooLarge):
+        read_base64_attachment("big.txt", "text/plain", content, max_bytes=1000)
+    assert read_base64_attachment("ok.txt", "text/plain", content, max_bytes=1200)
+
+
+def test_unsupported_and_empty_attachments_are_errors():
+    with pytest.raises(AttachmentError):
+        AttachmentReader("photo.png", "image/png")
+    with pytest.raises(AttachmentError):
+        read_base64_attachment("blank.txt", "text/plain", base64.b64encode(b" \n ").decode())
+
+
+def test_pdf_text_extraction():
+    content = zlib.compress(b"BT /F1 12 Tf (Allergic to \\(penicillin\\)) Tj ET")
+    pdf = make_pdf(content, b"BT (Uncompressed line) Tj ET")
+    assert extract_pdf_text(pdf) == "Allergic to (penicillin)\nUncompressed line"
+
+
+def test_pdf_inflate_is_capped():
+    bomb = zlib.compress(b"0" * (1024 * 1024))
+    assert len(bomb) < 2048
+    with pytest.raises(AttachmentTooLarge):
+        extract_pdf_text(make_pdf(bomb), max_inflated_bytes=64 * 1024)
+    # The cap is over the whole file, not per stream
+    half = zlib.compress(b"0" * (40 * 1024))
+    with pytest.raises(AttachmentTooLarge):
+        extract_pdf_text(make_pdf(half, half), max_inflated_bytes=64 * 1024)
+
+
+def test_pdf_without_text_is_an_error():
+    pdf = make_pdf(zlib.compress(b"q 100 0 0 100 0 0 cm /Im1 Do Q"))  # An image-only page
+    with pytest.raises(AttachmentError, match="No text"):
+        read_base64_attachment("scan.pdf", "application/pdf", base64.b64encode(pdf).decode())
+
+
+def test_request_limit_fits_every_allowed_attachment():
+    wrapped = base64.encodebytes(b"\xff" * MAX_ATTACHMENT_BYTES).decode().replace("\n", "\r\n")
+    content = "data:application/pdf;base64," + wrapped
+    assert len(content) <= max_base64_chars(MAX_ATTACHMENT_BYTES)
+    assert MAX_ATTACHMENTS_PER_REQUEST * len(content) < MAX_REQUEST_BYTES
+
+
+def test_session_search_and_anonymous_sessions():
+    store = SessionIndexStore()
+    store.add("session-a", "notes.txt", [NOTES])
+    assert store.search("session-a", "penicillin allergy")[0]["answer"] == NOTES
+    assert store.search("session-b", "penicillin allergy") == []
+    with pytest.raises(AttachmentError):
+        store.add("guest", "notes.txt", [NOTES])
+    assert store.search("guest", "penicillin") == []
+
+
+def test_idle_sessions_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(attachments.time, "monotonic", lambda: now[0])
+    store = SessionIndexStore(ttl_seconds=60)
+    store.add("session-a", "notes.txt", [NOTES])
+    store.add("session-b", "notes.txt", [NOTES])
+
+    now[0] += 45
+    assert store.search("session-a", "burn")  # Touching a session keeps it alive
+    now[0] += 30
+    assert store.get_stats()["sessions"] == 2
+    store.evict_expired()
+    assert store.get_stats()["sessions"] == 1
+    assert store.search("session-a", "burn")
+    assert store.search("session-b", "burn") == []
+    assert store.get_stats()["evicted_sessions"] == 1
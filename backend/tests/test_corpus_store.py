@@ -0,0 +1,65 @@
+import json
+import struct
+import pytest
+from corpus_store import CorpusStore, MAGIC
+
+QUESTIONS = ["how to treat a burn?", "", "qué hacer con una quemadura", "鼻血の止め方", "last row"]
+ANSWERS = ["cool the burn under running water.", "empty question row", "", "座って前かがみになる 😀", "x" * 1001]
+ALIASES = [["burn treatment", "treating burns"], [], ["quemadura leve"], ["naso"], ["one", "two", "three"]]
+
+
+@pytest.fixture
+def saved_store(tmp_path):
+    store = CorpusStore.from_columns(QUESTIONS, ANSWERS, ALIASES, metadata={"source": {"csv": "x.csv"}, "dedup": None})
+    path = str(tmp_path / "corpus_store.bin")
+    store.save(path)
+    return path
+
+
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_round_trip_every_row(saved_store, use_mmap):
+    store = CorpusStore.load(saved_store, use_mmap=use_mmap)
+    assert len(store) == len(QUESTIONS)
+    for row in range(len(QUESTIONS)):
+        assert store.question(row) == QUESTIONS[row]
+        assert store.answer(row) == ANSWERS[row]
+        assert store.aliases(row) == ALIASES[row]
+    assert store.metadata == {"source": {"csv": "x.csv"}, "dedup": None}
+    assert store.get_stats()["memory_mapped"] is use_mmap
+
+
+def test_search_text_joins_question_and_aliases(saved_store):
+    store = CorpusStore.load(saved_store)
+    assert store.search_text(0) == "how to treat a burn? burn treatment treating burns"
+    assert store.search_text(1) == ""
+
+
+def test_offsets_arrays_are_8_byte_aligned(saved_store):
+    with open(saved_store, "rb") as f:
+        data = f.read()
+    assert data.startswith(MAGIC)
+    (header_len,) = struct.unpack_from("<Q", data, len(MAGIC))
+    base = len(MAGIC) + 8 + header_len
+    assert base % 8 == 0
+    header = json.loads(data[len(MAGIC) + 8:base])
+    for layout in header["columns"].values():
+        assert layout["offsets_at"] % 8 == 0
+
+
+def test_empty_store_round_trip(tmp_path):
+    path = str(tmp_path / "empty.bin")
+    CorpusStore.from_columns([], [], []).save(path)
+    store = CorpusStore.load(path)
+    assert len(store) == 0
+    assert store.get_stats()["buffer_bytes"] == 0
+
+
+def test_save_leaves_no_temp_file(tmp_path, saved_store):
+    assert not (tmp_path / "corpus_store.bin.tmp").exists()
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "not_a_store.bin"
+    path.write_bytes(b"PK\x03\x04 something else entirely")
+    with pytest.raises(ValueError):
+        CorpusStore.load(str(path))
@@ -0,0 +1,56 @@
+import itertools
+import numpy as np
+import pandas as pd
+from dedup import MinHashLSH, collapse_near_duplicates, jaccard, shingles, _MAX_HASH, _PRIME
+
+BURN = "cool the burn under cool running water for at least twenty minutes and cover it loosely with cling film"
+NOSEBLEED = "sit down lean forward and pinch the soft part of the nose for ten to fifteen minutes without letting go"
+
+
+def test_hash_family_is_exact():
+    lsh = MinHashLSH()
+    values = np.array([0, 1, _MAX_HASH], dtype=np.uint64)
+    hashes = (np.outer(values, lsh.a) + lsh.b) % _PRIME
+    for row, x in enumerate(values):
+        expected = [(int(a) * int(x) + int(b)) % _PRIME for a, b in zip(lsh.a, lsh.b)]
+        assert [int(h) for h in hashes[row]] == expected
+
+
+def test_collapses_near_duplicates_into_aliases():
+    df = pd.DataFrame({
+        "question": ["how do i treat a burn", "what to do for a burn", "how to stop a nosebleed", "how do i treat a burn"],
+        "answer": [BURN, BURN + " please", NOSEBLEED, BURN],
+    })
+    collapsed, stats = collapse_near_duplicates(df, threshold=0.8)
+
+    assert list(collapsed["question"]) == ["how do i treat a burn", "how to stop a nosebleed"]
+    assert collapsed["answer"][0] == BURN  # The first row of a group is canonical
+    # Other phrasings become aliases; an identical question is not repeated
+    assert collapsed["aliases"][0] == ["what to do for a burn"]
+    assert collapsed["aliases"][1] == []
+    assert stats == {"original_rows": 4, "collapsed_rows": 2, "groups_merged": 1, "reduction_pct": 50.0, "threshold": 0.8}
+
+
+def test_distinct_answers_are_kept():
+    df = pd.DataFrame({"question": ["burn", "nosebleed"], "answer": [BURN, NOSEBLEED]})
+    collapsed, stats = collapse_near_duplicates(df, threshold=0.8)
+    assert len(collapsed) == 2
+    assert stats["groups_merged"] == 0
+
+
+def test_lsh_finds_every_pair_above_threshold():
+    rng = np.random.RandomState(7)
+    vocabulary = [f"w{i}" for i in range(300)]
+    base_texts = [" ".join(rng.choice(vocabulary, 60)) for _ in range(20)]
+    texts = []
+    for text in base_texts:
+        words = text.split()
+        texts.append(text)
+        texts.append(" ".join(words[:-2] + ["extra", "words"]))  # High-overlap variant
+    shingle_sets = [shingles(text) for text in texts]
+    lsh = MinHashLSH()
+    candidates = lsh.candidate_pairs([lsh.signature(s) for s in shingle_sets])
+    true_pairs = [(i, j) for i, j in itertools.combinations(range(len(texts)), 2)
+                  if jaccard(shingle_sets[i], shingle_sets[j]) >= 0.8]
+    assert true_pairs
+    assert all(pair in candidates for pair in true_pairs)
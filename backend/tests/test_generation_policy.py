@@ -0,0 +1,115 @@
+import re
+import threading
+from generation_policy import ANSWER_MAX_WORDS, QUERY_CLASSES, GenerationPolicy, HtmlCompletionTracker
+
+
+def stream(tracker, text, size=7):
+    for i in range(0, len(text), size):
+        tracker.feed(text[i:i + size])
+
+
+def test_tracker_completion():
+    tracker = HtmlCompletionTracker()
+    stream(tracker, "<h3>Steps</h3><ol><li>Cool the <strong>burn</strong></li>")
+    assert not tracker.is_complete()  # <ol> still open
+    stream(tracker, "</ol>")
+    assert tracker.is_complete()
+    stream(tracker, "<p>Call for help")
+    assert not tracker.is_complete()
+    assert tracker.word_count() == 7
+
+
+def test_tracker_ignores_plain_text():
+    tracker = HtmlCompletionTracker()
+    stream(tracker, "No markup at all.")
+    assert not tracker.is_complete()
+
+
+def paragraphs(words):
+    return f"<p>{' '.join(['word'] * words)}.</p>"
+
+
+def stop_point(answer, plan):
+    """Words streamed when the answer would be cut, or None if it runs to the end"""
+    tracker = HtmlCompletionTracker()
+    for token in re.findall(r"<[^>]*>|[^<]+?(?=\s|<|$)\s*", answer):  # Tags and words, like Ollama's tokens
+        tracker.feed(token)
+        if tracker.should_stop(plan["stop_words"], plan["runaway_words"]):
+            return tracker.word_count()
+    return None
+
+
+def test_stops_after_the_closing_section_of_a_long_enough_answer():
+    plan = GenerationPolicy().plan("qwen2:1.5b", "emergency_steps")
+    steps = "".join(f"<li>{' '.join(['word'] * 30)}</li>" for _ in range(5))
+    answer = (f"<h3>Steps</h3><ol>{steps}</ol><h3>When to seek help</h3>{paragraphs(20)}"
+              f"<p>Anything the model adds after the closing section.</p>")
+    words = stop_point(answer, plan)
+    assert words == 1 + 150 + 4 + 20  # Cut right after the closing section, before the extra paragraph
+
+
+def test_short_answers_and_middle_sections_run_to_the_end():
+    plan = GenerationPolicy().plan("qwen2:1.5b", "general")
+    # A closing section before the lower bound does not end the answer
+    short = f"<h3>Overview</h3>{paragraphs(40)}<h3>Warning</h3>{paragraphs(20)}<h3>Steps</h3>{paragraphs(30)}"
+    assert stop_point(short, plan) is None
+    # Neither does a long answer whose last section is not a closing one
+    body = f"<h3>Overview</h3>{paragraphs(100)}<h3>Steps</h3>{paragraphs(100)}"
+    assert stop_point(body, plan) is None
+
+
+def test_runaway_answers_are_cut_at_a_complete_block():
+    plan = GenerationPolicy().plan("qwen2:1.5b", "general")
+    answer = f"<h3>Overview</h3>" + paragraphs(100) * 4
+    assert stop_point(answer, plan) == 1 + 300
+    assert plan["runaway_words"] > ANSWER_MAX_WORDS
+
+
+def test_probe_never_stops_early():
+    plan = GenerationPolicy().plan("qwen2:1.5b", "probe")
+    assert stop_point(f"<h3>A</h3>{paragraphs(300)}<h3>Summary</h3>{paragraphs(5)}", plan) is None
+
+
+def test_early_stops_stay_out_of_the_history():
+    policy = GenerationPolicy()
+    for _ in range(10):
+        policy.record("qwen2:1.5b", "general", 400)
+    before = policy.get_num_predict("qwen2", "general")
+    for _ in range(20):
+        policy.record("qwen2:1.5b", "general", 50, stopped_early=True)
+    assert policy.get_num_predict("qwen2", "general") == before
+    assert policy.get_stats()[0]["early_stops"] == 20
+
+
+def test_num_predict_tracks_history_within_bounds():
+    policy = GenerationPolicy()
+    config = QUERY_CLASSES["definition"]
+    assert policy.get_num_predict("phi3", "definition") == config["num_predict"]
+    for _ in range(20):
+        policy.record("phi3:mini", "definition", 10)
+    assert policy.get_num_predict("phi3", "definition") == config["min_predict"]
+    for _ in range(50):
+        policy.record("phi3:mini", "definition", 10000)
+    assert policy.get_num_predict("phi3", "definition") == config["max_predict"]
+
+
+def test_concurrent_record_and_plan():
+    policy = GenerationPolicy(history_size=20)
+    errors = []
+
+    def worker(seed):
+        try:
+            for i in range(2000):
+                policy.record("qwen2:1.5b", "general", 100 + (seed * i) % 300, stopped_early=i % 7 == 0)
+                policy.plan("qwen2:1.5b", "general")
+                policy.get_stats()
+        except Exception as e:  # e.g. "deque mutated during iteration"
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert policy.get_stats()[0]["samples"] == 20
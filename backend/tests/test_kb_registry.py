@@ -0,0 +1,107 @@
+import pytest
+from knowledge_base import GenerationManager
+from kb_registry import KnowledgeBaseRegistry
+
+CORPORA = {
+    "default": [("how do i treat a burn?", "cool the burn under cool running water for twenty minutes.")],
+    "pediatric": [("how do i treat a burn on a baby?", "cool it with lukewarm water and call a doctor.")],
+    "wilderness": [("how do i treat a burn on a trail?", "cool it with stream water and cover it loosely.")],
+    "marine": [("how do i treat a burn on a boat?", "cool it with fresh water and keep it out of the sun.")],
+}
+
+
+def write_csv(tmp_path, name):
+    path = tmp_path / f"{name}.csv"
+    path.write_text("question,answer\n" + "".join(f'"{q}","{a}"\n' for q, a in CORPORA[name]))
+    return str(path)
+
+
+@pytest.fixture
+def default_manager(tmp_path):
+    manager = GenerationManager(write_csv(tmp_path, "default"), str(tmp_path / "generations"),
+                                dedup_threshold=None, use_subprocess=False)
+    manager.load_initial()
+    yield manager
+    manager.close()
+
+
+def make_registry(tmp_path, default_manager, resident_corpora, num_shards=1):
+    """A registry whose budget fits the default plus `resident_corpora` of the (similar-sized) named corpora"""
+    entries = {name: {"csv_path": write_csv(tmp_path, name)} for name in CORPORA if name != "default"}
+    registry = KnowledgeBaseRegistry(default_manager, entries, root_dir=str(tmp_path / "collections"),
+                                     memory_budget_bytes=0, num_shards=num_shards)
+    # Size the budget from a real load, then start from an empty cache
+    probe = registry.acquire("pediatric")
+    corpus_bytes = probe.memory_bytes()
+    probe.release()
+    registry.evict("pediatric")
+    registry.stats = dict.fromkeys(registry.stats, 0)
+    registry.memory_budget_bytes = default_manager.current.memory_bytes() + int(corpus_bytes * (resident_corpora + 0.5))
+    return registry
+
+
+def use(registry, name):
+    knowledge_base = registry.acquire(name)
+    knowledge_base.release()
+    return knowledge_base
+
+
+def resident_names(registry):
+    return [entry["name"] for entry in registry.get_stats()["resident"]]
+
+
+def test_default_is_served_without_loading(tmp_path, default_manager):
+    registry = make_registry(tmp_path, default_manager, resident_corpora=1)
+    assert use(registry, None) is default_manager.current
+    assert use(registry, "default") is default_manager.current
+    assert registry.get_stats()["misses"] == 0
+
+
+def test_unknown_name_raises(tmp_path, default_manager):
+    registry = make_registry(tmp_path, default_manager, resident_corpora=1)
+    assert not registry.has("nope")
+    with pytest.raises(KeyError):
+        registry.acquire("nope")
+
+
+def test_hits_misses_and_lru_eviction(tmp_path, default_manager):
+    registry = make_registry(tmp_path, default_manager, resident_corpora=2)
+    use(registry, "pediatric")
+    use(registry, "wilderness")
+    use(registry, "pediatric")  # Now wilderness is least recently used
+    assert resident_names(registry) == ["wilderness", "pediatric"]
+
+    use(registry, "marine")
+    assert resident_names(registry) == ["pediatric", "marine"]
+    stats = registry.get_stats()
+    assert (stats["hits"], stats["misses"], stats["loads"], stats["evictions"]) == (1, 3, 3, 1)
+    assert stats["resident_bytes"] <= stats["memory_budget_bytes"]
+
+
+def test_evicted_corpus_reloads_from_its_artifacts(tmp_path, default_manager):
+    registry = make_registry(tmp_path, default_manager, resident_corpora=1)
+    first = use(registry, "pediatric")
+    use(registry, "wilderness")
+    again = use(registry, "pediatric")
+    assert again is not first
+    assert again.generation_id == first.generation_id  # Loaded from the pointer, not rebuilt
+    assert registry.get_stats()["evictions"] == 2
+
+
+def test_eviction_waits_for_requests_holding_the_corpus(tmp_path, default_manager):
+    registry = make_registry(tmp_path, default_manager, resident_corpora=1, num_shards=2)
+    held = registry.acquire("pediatric")
+    expected = held.search("burn baby", top_k=1)
+
+    # Loading a second corpus goes over budget and evicts the one still in use
+    other = registry.acquire("wilderness")
+    assert resident_names(registry) == ["wilderness"]
+    assert not held.searcher.closed
+    assert held.search("burn baby", top_k=1) == expected
+
+    held.release()
+    assert held.searcher.closed
+    other.release()
+    assert not other.searcher.closed
+    registry.evict("wilderness")
+    assert other.searcher.closed
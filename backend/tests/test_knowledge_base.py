@@ -0,0 +1,130 @@
+import os
+import time
+import pytest
+from knowledge_base import GenerationManager, KnowledgeBase
+
+ROWS = [
+    ("how do you treat choking?", "give five back blows between the shoulder blades then five abdominal thrusts."),
+    ("how do i treat a burn?", "cool the burn under cool running water for twenty minutes."),
+    ("how do i stop a nosebleed?", "sit down lean forward and pinch the soft part of the nose."),
+    ("what should i do for a snake bite?", "keep the person still and call emergency services."),
+]
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "corpus.csv"
+    path.write_text("question,answer\n" + "".join(f'"{q}","{a}"\n' for q, a in ROWS))
+    return str(path)
+
+
+@pytest.mark.parametrize("num_shards", [1, 2])
+def test_search_finds_the_matching_entry(csv_path, tmp_path, num_shards):
+    knowledge_base = KnowledgeBase(csv_path, str(tmp_path / "gen"), dedup_threshold=None, num_shards=num_shards).load()
+    try:
+        assert knowledge_base.search("burn", top_k=1)[0]["question"] == "how do i treat a burn?"
+    finally:
+        knowledge_base.close()
+
+
+def test_closed_sharded_generation_still_searches_correctly(csv_path, tmp_path):
+    knowledge_base = KnowledgeBase(csv_path, str(tmp_path / "gen"), dedup_threshold=None, num_shards=2).load()
+    before = knowledge_base.search("burn", top_k=2)
+    knowledge_base.close()
+    assert knowledge_base.search("burn", top_k=2) == before
+
+
+def test_search_without_vectors_raises(csv_path, tmp_path):
+    knowledge_base = KnowledgeBase(csv_path, str(tmp_path / "gen"), dedup_threshold=None).load()
+    query_vector = knowledge_base.vectorize("burn")
+    knowledge_base.question_vectors = None
+    with pytest.raises(RuntimeError):
+        knowledge_base.search_vector(query_vector)
+
+
+def wait_for_rebuild(manager, timeout=60):
+    deadline = time.time() + timeout
+    while manager.status["state"] == "building":
+        assert time.time() < deadline, "rebuild did not finish"
+        time.sleep(0.05)
+    return manager.status["state"]
+
+
+@pytest.fixture
+def other_csv_path(tmp_path):
+    path = tmp_path / "other.csv"
+    path.write_text('question,answer\n"how do i treat a bee sting?","scrape the sting out and apply a cold pack."\n')
+    return str(path)
+
+
+@pytest.fixture
+def manager(csv_path, tmp_path):
+    manager = GenerationManager(csv_path, str(tmp_path / "generations"), dedup_threshold=None, use_subprocess=False)
+    manager.load_initial()
+    yield manager
+    manager.close()
+
+
+def test_hot_swap_keeps_previous_for_rollback(manager, other_csv_path):
+    first = manager.current
+    assert manager.start_rebuild(other_csv_path)
+    assert wait_for_rebuild(manager) == "ready"
+    assert manager.current is not first and manager.previous is first
+    assert manager.current.search("bee sting", top_k=1)[0]["question"] == "how do i treat a bee sting?"
+
+    assert manager.rollback()
+    assert manager.current is first
+    assert manager.csv_path == first.csv_path
+
+
+def test_pointer_records_generation_and_corpus(manager, other_csv_path, csv_path, tmp_path):
+    manager.start_rebuild(other_csv_path)
+    wait_for_rebuild(manager)
+    generation_id = manager.current.generation_id
+
+    # A restart with the original default CSV must come back on the rebuilt corpus, without rebuilding it
+    restarted = GenerationManager(csv_path, str(tmp_path / "generations"), dedup_threshold=None, use_subprocess=False)
+    knowledge_base = restarted.load_initial()
+    assert knowledge_base.generation_id == generation_id
+    assert knowledge_base.csv_path == other_csv_path
+    assert len(knowledge_base) == 1
+    restarted.close()
+
+
+def test_failed_rebuild_keeps_serving(manager, tmp_path):
+    serving = manager.current
+    empty_csv = tmp_path / "empty.csv"
+    empty_csv.write_text("question,answer\n")
+    manager.start_rebuild(str(empty_csv))
+    assert wait_for_rebuild(manager) == "failed"
+    assert manager.current is serving
+    assert not os.path.exists(os.path.join(manager.root_dir, manager.status["generation_id"]))
+
+
+def test_concurrent_rebuilds_are_refused(manager, other_csv_path):
+    assert manager.start_rebuild(other_csv_path)
+    assert not manager.start_rebuild(other_csv_path)
+    wait_for_rebuild(manager)
+
+
+def test_retired_generation_closes_after_its_last_reader(csv_path, other_csv_path, tmp_path):
+    manager = GenerationManager(csv_path, str(tmp_path / "generations"), dedup_threshold=None,
+                                use_subprocess=False, num_shards=2)
+    manager.load_initial()
+    pinned = manager.acquire()
+    expected = pinned.search("burn", top_k=2)
+
+    # Two swaps push the pinned generation out of current and previous, and prune its directory
+    for path in (other_csv_path, csv_path):
+        manager.start_rebuild(path)
+        assert wait_for_rebuild(manager) == "ready"
+    assert pinned not in (manager.current, manager.previous)
+    assert not os.path.exists(pinned.artifact_dir)
+
+    # The in-flight request still gets its workers and the same answers
+    assert not pinned.searcher.closed
+    assert pinned.search("burn", top_k=2) == expected
+    pinned.release()
+    assert pinned.searcher.closed
+    assert pinned.search("burn", top_k=2) == expected
+    manager.close()
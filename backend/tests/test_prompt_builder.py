@@ -0,0 +1,52 @@
+from prompt_builder import PromptBuilder, estimate_tokens, select_context_sentences, split_sentences
+
+BURN_MATCH = {
+    "question": "how do i treat a burn",
+    "answer": "Cool the burn under running water for twenty minutes. Remove jewellery near the burn. "
+              "Cover the burn loosely with cling film. Do not apply butter or ice.",
+    "similarity": 0.8,
+}
+SIMILAR_BURN_MATCH = {
+    "question": "what to do for a scald",
+    "answer": "Cool the burn under running water for twenty minutes. Keep the person warm.",
+    "similarity": 0.6,
+}
+OFF_TOPIC_MATCH = {
+    "question": "how to splint a broken hand",
+    "answer": "Support the broken hand with a rolled magazine.",
+    "similarity": 0.2,
+}
+
+
+def test_context_keeps_reading_order_and_skips_repeats():
+    context, tokens = select_context_sentences("how to treat a burn", [BURN_MATCH, SIMILAR_BURN_MATCH], 500)
+    assert context.startswith("Cool the burn under running water for twenty minutes.")
+    assert context.count("Cool the burn under running water") == 1
+    assert tokens == sum(estimate_tokens(sentence) for sentence in split_sentences(context))
+
+
+def test_weak_secondary_matches_are_dropped():
+    context, _ = select_context_sentences("how to treat a burn", [BURN_MATCH, OFF_TOPIC_MATCH], 500)
+    assert "broken hand" not in context
+
+
+def test_context_respects_the_budget():
+    _, tokens = select_context_sentences("how to treat a burn", [BURN_MATCH, SIMILAR_BURN_MATCH], 20)
+    assert 0 < tokens <= 20
+
+
+def test_attachments_get_their_own_section():
+    attachment = {"question": "attachment: summary.txt", "source": "attachment", "similarity": 0.9,
+                  "answer": "Patient had a burn on the left arm last year. Follow up with cardiology."}
+    built = PromptBuilder().build("how to treat a burn", [BURN_MATCH], "qwen2:1.5b", attachment_matches=[attachment])
+    prompt = built["prompt"]
+    knowledge, excerpts = prompt.split("uploaded documents:")
+    assert "Cool the burn" in knowledge and "left arm" not in knowledge
+    assert "Patient had a burn on the left arm last year." in excerpts
+    assert "cardiology" not in prompt  # No overlap with the question
+
+
+def test_ungrounded_prompt_without_matches():
+    built = PromptBuilder().build("hello there", [], "mistral")
+    assert built["context_tokens"] == 0
+    assert "knowledge base information" not in built["prompt"]
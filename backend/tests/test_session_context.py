@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from sklearn.preprocessing import normalize
+from enhanced_rag import EnhancedFirstAidRAG
+from knowledge_base import KnowledgeBase
+
+ROWS = [
+    ("how do i treat a burn?", "cool the burn under cool running water for twenty minutes."),
+    ("how long should i cool a burn?", "keep the burn under running water for at least twenty minutes."),
+    ("how do i stop a nosebleed?", "sit down lean forward and pinch the soft part of the nose."),
+    ("how long should i pinch a nosebleed?", "pinch the nose for ten to fifteen minutes without letting go."),
+    ("what should i do for a snake bite?", "keep the person still and call emergency services."),
+]
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "corpus.csv"
+    path.write_text("question,answer\n" + "".join(f'"{q}","{a}"\n' for q, a in ROWS))
+    return str(path)
+
+
+@pytest.fixture
+def knowledge_base(csv_path, tmp_path):
+    return KnowledgeBase(csv_path, str(tmp_path / "gen-a"), dedup_threshold=None, generation_id="gen-a").load()
+
+
+@pytest.fixture
+def rag(csv_path):
+    return EnhancedFirstAidRAG(csv_path=csv_path)
+
+
+def ask(rag, knowledge_base, query, profile_id="session-a", is_follow_up=True):
+    return rag.search_with_session_context(query, profile_id, is_follow_up, knowledge_base, top_k=3)
+
+
+def test_follow_ups_blend_with_geometric_decay(rag, knowledge_base):
+    turns = ["how do i treat a burn", "how long should i pinch", "what about a snake"]
+    ask(rag, knowledge_base, turns[0], is_follow_up=False)
+    results = [ask(rag, knowledge_base, turn) for turn in turns[1:]]
+
+    q1, q2, q3 = (knowledge_base.vectorize(turn) for turn in turns)
+    second = normalize(q2 + 0.5 * q1)
+    third = normalize(q3 + 0.5 * second)
+    # Each older turn is scaled down by another factor of follow_up_decay
+    assert np.allclose(rag.session_query_cache["session-a"]["vector"].toarray(), third.toarray())
+    assert results == [knowledge_base.search_vector(second, 3), knowledge_base.search_vector(third, 3)]
+
+
+def test_follow_up_stays_on_topic(rag, knowledge_base):
+    # On its own the follow-up ties the burn and nosebleed "how long" entries
+    query = "how long should i keep going"
+    assert len({round(r["similarity"], 9) for r in knowledge_base.search(query, 2)}) == 1
+    ask(rag, knowledge_base, "how do i stop a nosebleed", is_follow_up=False)
+    top_two = [r["question"] for r in ask(rag, knowledge_base, query)[:2]]
+    assert all("nosebleed" in question for question in top_two)
+
+
+def test_new_topic_is_not_blended(rag, knowledge_base):
+    ask(rag, knowledge_base, "how do i stop a nosebleed", is_follow_up=False)
+    results = ask(rag, knowledge_base, "how do i treat a burn", is_follow_up=False)
+    assert results == knowledge_base.search("how do i treat a burn", 3)
+
+
+def test_follow_up_without_searchable_words_reuses_the_last_results(rag, knowledge_base, monkeypatch):
+    first = ask(rag, knowledge_base, "how do i treat a burn", is_follow_up=False)
+    cached_vector = rag.session_query_cache["session-a"]["vector"]
+
+    monkeypatch.setattr(knowledge_base, "search_vector", lambda *args: pytest.fail("should not search"))
+    assert knowledge_base.vectorize("xyzzy plugh").nnz == 0
+    assert ask(rag, knowledge_base, "xyzzy plugh") == first
+    assert rag.session_query_cache["session-a"]["vector"] is cached_vector
+
+
+def test_cache_from_another_generation_is_ignored(rag, knowledge_base, csv_path, tmp_path):
+    ask(rag, knowledge_base, "how do i stop a nosebleed", is_follow_up=False)
+    rebuilt = KnowledgeBase(csv_path, str(tmp_path / "gen-b"), dedup_threshold=None, generation_id="gen-b").load()
+
+    query = "how long should i cool it"
+    assert ask(rag, rebuilt, query) == rebuilt.search(query, 3)
+    assert rag.session_query_cache["session-a"]["generation_id"] == "gen-b"
+
+
+def test_cache_is_capped_lru(rag, knowledge_base):
+    rag.max_cached_sessions = 2
+    for profile_id in ("session-a", "session-b"):
+        ask(rag, knowledge_base, "burn", profile_id, is_follow_up=False)
+    ask(rag, knowledge_base, "nosebleed", "session-a")  # session-b is now least recently used
+    ask(rag, knowledge_base, "snake bite", "session-c", is_follow_up=False)
+    assert list(rag.session_query_cache) == ["session-a", "session-c"]
+
+    rag.clear_profile_history("session-a")
+    assert list(rag.session_query_cache) == ["session-c"]
+
+
+@pytest.mark.parametrize("anonymous", ["guest", None, ""])
+def test_anonymous_users_do_not_share_a_topic(rag, knowledge_base, anonymous):
+    # One anonymous user asks about nosebleeds...
+    ask(rag, knowledge_base, "how do i stop a nosebleed", anonymous, is_follow_up=False)
+    # ...and another anonymous user's follow-up must not be steered by it
+    query = "how long should i cool it"
+    assert ask(rag, knowledge_base, query, anonymous) == knowledge_base.search(query, 3)
+    assert len(rag.session_query_cache) == 0
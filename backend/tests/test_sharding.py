@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+from sharding import ShardedSearcher, merge_top_k
+
+DOCS = [f"first aid for {topic} step {i}" for i in range(40)
+        for topic in ("burns", "nosebleeds", "snake bites", "choking")]
+QUERIES = ["how to treat burns", "nosebleeds step 3", "snake bites", "unrelated words entirely"]
+
+
+def in_process_top_k(vectors, query_vector, top_k):
+    similarities = cosine_similarity(query_vector, vectors)[0]
+    return sorted(similarities, reverse=True)[:top_k]
+
+
+def test_merge_top_k_matches_global_sort():
+    rng = np.random.RandomState(0)
+    per_shard = []
+    offset = 0
+    for size in (5, 0, 7, 3):
+        scores = sorted(rng.rand(size), reverse=True)
+        per_shard.append([(float(score), offset + i) for i, score in enumerate(scores)])
+        offset += size
+    merged = merge_top_k(per_shard, 6)
+    expected = sorted((item for shard in per_shard for item in shard), key=lambda item: -item[0])[:6]
+    assert merged == expected
+
+
+@pytest.fixture(scope="module")
+def vectorized():
+    vectorizer = TfidfVectorizer()
+    return vectorizer, vectorizer.fit_transform(DOCS)
+
+
+@pytest.fixture(scope="module")
+def searcher(vectorized, tmp_path_factory):
+    _, vectors = vectorized
+    searcher = ShardedSearcher(vectors, str(tmp_path_factory.mktemp("shards")), num_shards=3)
+    yield searcher
+    searcher.close()
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_scatter_gather_matches_in_process_search(vectorized, searcher, query):
+    vectorizer, vectors = vectorized
+    query_vector = vectorizer.transform([query])
+    for top_k in (1, 5, 50):
+        sharded = searcher.search(query_vector, top_k)
+        assert [round(score, 9) for score, _ in sharded] == [round(s, 9) for s in in_process_top_k(vectors, query_vector, top_k)]
+        # Rows point back at documents with exactly those scores
+        for score, row in sharded:
+            assert abs(cosine_similarity(query_vector, vectors[row])[0][0] - score) < 1e-9
+
+
+def test_local_fallback_matches_workers(vectorized, searcher):
+    vectorizer, _ = vectorized
+    query_vector = vectorizer.transform(["how to treat burns"])
+    assert searcher.search_local(query_vector, 5) == searcher.search(query_vector, 5)
+
+
+def test_shard_stats(searcher):
+    stats = searcher.get_stats()
+    assert [s["shard"] for s in stats] == [0, 1, 2]
+    assert sum(s["rows"] for s in stats) == len(DOCS)
+
+
+def test_search_after_close_uses_the_mapped_shards(vectorized, tmp_path):
+    vectorizer, vectors = vectorized
+    searcher = ShardedSearcher(vectors, str(tmp_path / "shards"), num_shards=2)
+    query_vector = vectorizer.transform(["snake bites"])
+    expected = searcher.search(query_vector, 5)
+    searcher.close()
+    # The generation directory may be pruned while requests still hold it
+    for path in (tmp_path / "shards").iterdir():
+        path.unlink()
+    assert searcher.search(query_vector, 5) == expected
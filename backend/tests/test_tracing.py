@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tracing import MAX_PROFILES_PER_MINUTE, MIN_PROFILE_INTERVAL_MS, SamplingProfiler, Tracer
+
+
+def read_events(path):
+    # The format allows a missing closing bracket; the writer leaves a trailing comma
+    return json.loads(path.read_text().rstrip().rstrip(",") + "]")
+
+
+def test_spans_carry_the_request_ids(tmp_path):
+    trace_file = tmp_path / "trace.json"
+    tracer = Tracer(str(trace_file))
+    with tracer.request("req-1", "session-a", name="ask"):
+        with tracer.span("search", top_k=3) as args:
+            args["results"] = 2
+    tracer.record_span("outside", 0.0, 0.5)
+
+    search, ask, outside = read_events(trace_file)
+    assert (search["name"], ask["name"]) == ("search", "ask")
+    assert search["args"] == {"request_id": "req-1", "session_id": "session-a", "top_k": 3, "results": 2}
+    assert ask["args"] == {"request_id": "req-1", "session_id": "session-a"}
+    assert ask["dur"] >= search["dur"]
+    assert outside["args"] == {} and outside["dur"] == 500000
+
+
+def test_disabled_without_a_trace_file(tmp_path):
+    tracer = Tracer(None)
+    with tracer.request("req-1"), tracer.span("search"):
+        pass
+    assert not tracer.enabled
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_trace_file_rotates_at_max_bytes(tmp_path):
+    trace_file = tmp_path / "trace.json"
+    tracer = Tracer(str(trace_file), max_bytes=1000)
+    for i in range(50):
+        tracer.record_span(f"span-{i}", 0.0, 0.001, padding="x" * 50)
+
+    rotated = tmp_path / "trace.json.1"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["trace.json", "trace.json.1"]
+    assert trace_file.stat().st_size < 1000 + 300
+    # Both files stay loadable, and the newest span is in the live one
+    assert read_events(trace_file)[-1]["name"] == "span-49"
+    assert read_events(rotated)
+
+
+def busy_work(seconds):
+    deadline = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < deadline:
+        total += sum(range(100))
+    return total
+
+
+def test_profiler_samples_the_worker_thread(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path / "profiles.folded"), sample_rate_pct=100, interval_ms=2)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        assert pool.submit(profiler.call, "ask:1", busy_work, 0.2).result() > 0
+
+    status = profiler.get_status()
+    assert status["profiled_requests"] == 1
+    lines = (tmp_path / "profiles.folded").read_text().splitlines()
+    assert lines and all(line.startswith("ask:1;") for line in lines)
+    assert any("busy_work (test_tracing.py" in line for line in lines)
+
+
+def test_profiler_saves_on_the_calling_thread(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path / "profiles.folded"), sample_rate_pct=100)
+    saved_on = []
+    original_save = profiler._save
+    profiler._save = lambda label, stacks: (saved_on.append(threading.get_ident()), original_save(label, stacks))
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        worker = pool.submit(threading.get_ident).result()
+        pool.submit(profiler.call, "ask:1", time.sleep, 0.01).result()
+    assert saved_on == [worker]
+
+
+def test_profiler_rate_limit(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path / "profiles.folded"), sample_rate_pct=100, max_profiles_per_minute=2)
+    for _ in range(5):
+        profiler.call("ask", time.sleep, 0)
+    assert profiler.profiled_requests == 2
+    assert profiler.get_status()["skipped_by_rate_limit"] == 3
+
+
+def test_profiler_off_by_default(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path / "profiles.folded"))
+    with profiler.maybe_profile("ask") as sampled:
+        assert sampled is False
+    assert not (tmp_path / "profiles.folded").exists()
+
+
+def test_configure_clamps_to_the_hard_limits(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path / "profiles.folded"))
+    status = profiler.configure(sample_rate_pct=250, interval_ms=0.01, max_profiles_per_minute=10000)
+    assert status["sample_rate_pct"] == 100.0
+    assert status["interval_ms"] == MIN_PROFILE_INTERVAL_MS
+    assert status["max_profiles_per_minute"] == MAX_PROFILES_PER_MINUTE
+    assert profiler.configure(sample_rate_pct=-5)["enabled"] is False
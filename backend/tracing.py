@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# Hard limits for runtime profiler settings - sampling is never cheaper than this
+MIN_PROFILE_INTERVAL_MS = 2.0
+MAX_PROFILES_PER_MINUTE = 30
+
+# Request and session ids of the request being handled, attached to every span
+_current_request = contextvars.ContextVar("current_request", default=None)
+
+
+class Tracer:
+    """Per-request trace spans exported in the Chrome Trace Event Format.
+
+    Events are appended to a JSON array file that chrome://tracing, Perfetto and
+    speedscope can open directly (the format allows the closing bracket to be missing).
+    Tracing is off without a trace file; once the file reaches max_bytes it is rotated
+    to <trace_file>.1, so at most two files are kept.
+    """
+
+    def __init__(self, trace_file: Optional[str] = None, max_bytes: int = 50 * 1024 * 1024):
+        self.trace_file = trace_file
+        self.enabled = bool(trace_file)
+        self.max_bytes = max_bytes
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _write(self, event: Dict):
+        with self._lock:
+            if self._file is not None and self._file.tell() >= self.max_bytes:
+                self._file.close()
+                self._file = None
+                os.replace(self.trace_file, f"{self.trace_file}.1")
+            if self._file is None:
+                is_new = not os.path.exists(self.trace_file) or os.path.getsize(self.trace_file) == 0
+                self._file = open(self.trace_file, "a", encoding="utf-8")
+                if is_new:
+                    self._file.write("[\n")
+            self._file.write(json.dumps(event) + ",\n")
+            self._file.flush()
+
+    @contextmanager
+    def request(self, request_id: str, session_id: Optional[str] = None, name: str = "request"):
+        """Bind a request id and session id to every span opened inside, and trace the whole request"""
+        token = _current_request.set({"request_id": request_id, "session_id": session_id or "guest"})
+        try:
+            with self.span(name):
+                yield
+        finally:
+            _current_request.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """Trace a block of code as one span"""
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter()
+        try:
+            yield args  # Callers may add result details to args inside the block
+        finally:
+            self.record_span(name, start, time.perf_counter(), **args)
+
+    def record_span(self, name: str, start: float, end: float, **args):
+        """Record a span from perf_counter timestamps (for phases that don't fit a with-block)"""
+        if not self.enabled:
+            return
+        event_args = dict(_current_request.get() or {})
+        event_args.update(args)
+        try:
+            self._write({
+                "name": name,
+                "cat": "rag",
+                "ph": "X",
+                "ts": int(start * 1_000_000),
+                "dur": max(0, int((end - start) * 1_000_000)),
+                "pid": self.pid,
+                "tid": threading.get_ident(),
+                "args": event_args
+            })
+        except OSError as e:
+            print(f"Failed to write trace span '{name}': {e}")
+            self.enabled = False
+
+
+class SamplingProfiler:
+    """Opt-in, rate-limited sampling profiler for a percentage of requests.
+
+    A background thread samples the stack of the thread serving a profiled request
+    at a fixed interval and aggregates folded stacks (flamegraph.pl / speedscope format).
+    """
+
+    def __init__(self, output_file: str = "rag_profiles.folded", sample_rate_pct: float = 0.0,
+                 interval_ms: float = 5.0, max_profiles_per_minute: int = 6):
+        self.output_file = output_file
+        self.sample_rate_pct = sample_rate_pct
+        self.interval_ms = interval_ms
+        self.max_profiles_per_minute = max_profiles_per_minute
+        self.recent_starts = deque()
+        self.hot_stacks = Counter()  # Aggregated over all profiled requests since the last configure()
+        self.profiled_requests = 0
+        self.skipped_by_rate_limit = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate_pct > 0
+
+    def configure(self, sample_rate_pct: Optional[float] = None, interval_ms: Optional[float] = None,
+                  max_profiles_per_minute: Optional[int] = None) -> Dict:
+        """Switch the profiler on/off or retune it at runtime"""
+        with self._lock:
+            if sample_rate_pct is not None:
+                self.sample_rate_pct = max(0.0, min(100.0, float(sample_rate_pct)))
+            if interval_ms is not None:
+                self.interval_ms = max(MIN_PROFILE_INTERVAL_MS, float(interval_ms))
+            if max_profiles_per_minute is not None:
+                self.max_profiles_per_minute = max(1, min(MAX_PROFILES_PER_MINUTE, int(max_profiles_per_minute)))
+            self.hot_stacks.clear()
+            self.profiled_requests = 0
+            self.skipped_by_rate_limit = 0
+        return self.get_status()
+
+    def _should_profile(self) -> bool:
+        if not self.enabled or random.uniform(0, 100) >= self.sample_rate_pct:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while self.recent_starts and now - self.recent_starts[0] > 60:
+                self.recent_starts.popleft()
+            if len(self.recent_starts) >= self.max_profiles_per_minute:
+                self.skipped_by_rate_limit += 1
+                return False
+            self.recent_starts.append(now)
+            return True
+
+    @contextmanager
+    def maybe_profile(self, label: str):
+        """Profile the enclosed block if this request is sampled"""
+        if not self._should_profile():
+            yield False
+            return
+
+        target_thread = threading.get_ident()
+        stop_event = threading.Event()
+        stacks = Counter()
+
+        def sample():
+            interval = self.interval_ms / 1000.0
+            while not stop_event.wait(interval):
+                frame = sys._current_frames().get(target_thread)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks[";".join(reversed(stack))] += 1
+
+        sampler = threading.Thread(target=sample, name="rag-profiler", daemon=True)
+        sampler.start()
+        try:
+            yield True
+        finally:
+            stop_event.set()
+            sampler.join()
+            self._save(label, stacks)
+
+    def call(self, label: str, func, *args, **kwargs):
+        """Run func(*args, **kwargs), profiling it if this request is sampled.
+
+        The sampler follows the calling thread, so call this from the worker thread
+        that does the work (e.g. pass it to run_in_threadpool), not from the event loop.
+        """
+        with self.maybe_profile(label):
+            return func(*args, **kwargs)
+
+    def _save(self, label: str, stacks: Counter):
+        with self._lock:
+            self.profiled_requests += 1
+            self.hot_stacks.update(stacks)
+            try:
+                with open(self.output_file, "a", encoding="utf-8") as f:
+                    for stack, count in stacks.items():
+                        f.write(f"{label};{stack} {count}\n")
+            except OSError as e:
+                print(f"Failed to write profile samples: {e}")
+
+    def get_status(self, top_n: int = 10) -> Dict:
+        """Current settings plus the hottest leaf functions seen so far"""
+        with self._lock:
+            hot_stacks = list(self.hot_stacks.items())
+        leaf_counts = Counter()
+        for stack, count in hot_stacks:
+            leaf_counts[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaf_counts.values())
+        return {
+            "enabled": self.enabled,
+            "sample_rate_pct": self.sample_rate_pct,
+            "interval_ms": self.interval_ms,
+            "max_profiles_per_minute": self.max_profiles_per_minute,
+            "profiled_requests": self.profiled_requests,
+            "skipped_by_rate_limit": self.skipped_by_rate_limit,
+            "output_file": self.output_file,
+            "hot_spots": [
+                {"frame": frame, "samples": count, "pct": round(100.0 * count / total, 1)}
+                for frame, count in leaf_counts.most_common(top_n)
+            ]
+        }
+
+
+# Opt-in: set TRACE_FILE (e.g. rag_traces.json) to record spans
+tracer = Tracer(os.getenv("TRACE_FILE"), max_bytes=int(os.getenv("TRACE_MAX_BYTES", str(50 * 1024 * 1024))))
+profiler = SamplingProfiler(
+    output_file=os.getenv("PROFILE_FILE", "rag_profiles.folded"),
+    sample_rate_pct=float(os.getenv("PROFILE_SAMPLE_RATE_PCT", "0"))
+)